@@ -0,0 +1,49 @@
+"""
+Compares the encode/decode throughput and message sizes of the codecs registered in :mod:`carrot.codecs`
+
+Usage::
+
+    python benchmarks/serializers.py --iterations 10000
+
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from carrot.codecs import get_codec, _codecs  # noqa: E402
+
+
+PAYLOADS = {
+    'small': {'kwargs': {'user_id': 1234, 'send_email': True, 'subject': 'Welcome'}},
+    'numeric': {'args': [list(range(5000))], 'kwargs': {'weights': [i / 7 for i in range(5000)]}},
+    'nested': {'kwargs': {'rows': [{'id': i, 'name': 'row %i' % i, 'tags': ['a', 'b', 'c'], 'score': i * 1.5}
+                                   for i in range(1000)]}},
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the carrot message codecs')
+    parser.add_argument('-n', '--iterations', type=int, default=1000, help='The number of iterations per payload')
+    options = parser.parse_args()
+
+    codecs = sorted({codec.name for codec in _codecs.values()})
+    print('%-8s %-8s %10s %14s %14s' % ('payload', 'codec', 'size (B)', 'encode (op/s)', 'decode (op/s)'))
+
+    for payload_name, payload in PAYLOADS.items():
+        for name in codecs:
+            codec = get_codec(name)
+            body = codec.dumps(payload)
+            if isinstance(body, str):
+                body = body.encode()
+
+            encode = timeit.timeit(lambda: codec.dumps(payload), number=options.iterations)
+            decode = timeit.timeit(lambda: codec.loads(body), number=options.iterations)
+            print('%-8s %-8s %10i %14.0f %14.0f' % (payload_name, name, len(body), options.iterations / encode,
+                                                    options.iterations / decode))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+This module provides an asyncio publishing API, for publishing tasks from async views without blocking the event loop.
+
+Each event loop shares a single :class:`pika.adapters.asyncio_connection.AsyncioConnection` and channel per virtual
+host, which are opened the first time a message is published. The connections of event loops that have been closed
+(e.g. by `asyncio.run`) are released the next time a publisher is requested. Publishing a message only writes to the
+connection's buffer; the frames are sent by the event loop. The MessageLog (and any blob store or outbox writes) are
+made in a worker thread, as Django's ORM is synchronous.
+
+.. note::
+    Publisher confirms are not supported by the asyncio API
+
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+from typing import Dict, Any, Callable, Optional
+
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from carrot.objects import VirtualHost
+
+
+async def run_sync(func: Callable, *args, **kwargs) -> Any:
+    """
+    Runs a synchronous function in the event loop's default executor, and returns the result. The function is run in a
+    copy of the caller's context, so context variables (such as the :mod:`carrot.tasklog` capture) are kept
+    """
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, functools.partial(context.run, func, *args, **kwargs))
+
+
+class AsyncPublisher(object):
+    """
+    Holds the shared connection and channel of an event loop for a single virtual host. The connection is opened on
+    demand, and re-opened if it gets closed
+    """
+
+    def __init__(self, virtual_host: VirtualHost, loop: asyncio.AbstractEventLoop) -> None:
+        self.virtual_host = virtual_host
+        self.loop = loop
+        self.connection: Optional[AsyncioConnection] = None
+        self._channel: Optional[pika.channel.Channel] = None
+        self._lock = asyncio.Lock()
+
+    async def channel(self) -> pika.channel.Channel:
+        """
+        Returns the open channel, connecting first if required. Concurrent callers share a single connection attempt
+        """
+        if self._channel and self._channel.is_open:
+            return self._channel
+
+        async with self._lock:
+            if self._channel and self._channel.is_open:
+                return self._channel
+
+            opened = self.loop.create_future()
+
+            def on_channel_open(channel: pika.channel.Channel) -> None:
+                channel.add_on_close_callback(self.on_channel_closed)
+                if not opened.done():
+                    opened.set_result(channel)
+
+            def on_connection_open(connection: AsyncioConnection) -> None:
+                connection.channel(on_open_callback=on_channel_open)
+
+            def on_open_error(connection: AsyncioConnection, error: Any = None) -> None:
+                if not opened.done():
+                    opened.set_exception(pika.exceptions.AMQPConnectionError(error))
+
+            self.connection = AsyncioConnection(self.virtual_host.connection_parameters,
+                                                on_open_callback=on_connection_open,
+                                                on_open_error_callback=on_open_error,
+                                                on_close_callback=self.on_connection_closed,
+                                                custom_ioloop=self.loop)
+            self._channel = await opened
+            return self._channel
+
+    def on_channel_closed(self, *args) -> None:
+        self._channel = None
+
+    def on_connection_closed(self, *args) -> None:
+        self._channel = None
+        self.connection = None
+
+    async def publish(self, formatter: Any) -> None:
+        """
+        Publishes a message using the given :class:`carrot.objects.BaseMessageSerializer`
+        """
+        channel = await self.channel()
+        kwargs = formatter.publish_kwargs()
+        kwargs['properties'] = pika.BasicProperties(**formatter.properties())
+        channel.basic_publish(**kwargs)
+
+    async def close(self) -> None:
+        if self.connection and self.connection.is_open:
+            self.connection.close()
+
+    def abort(self) -> None:
+        """
+        Closes the connection's socket once its event loop has been closed, as the connection can no longer be closed
+        cleanly
+        """
+        sock = getattr(self.connection, 'socket', None)
+        if sock is not None:
+            sock.close()
+
+        self._channel = None
+        self.connection = None
+
+
+_publishers: Dict[asyncio.AbstractEventLoop, Dict[str, AsyncPublisher]] = {}
+_publishers_lock = threading.Lock()
+
+
+def get_publisher(virtual_host: VirtualHost) -> AsyncPublisher:
+    """
+    Returns the :class:`AsyncPublisher` of the running event loop for the given virtual host. The publishers of closed
+    event loops are dropped, so that neither the loops nor their connections are leaked
+    """
+    loop = asyncio.get_event_loop()
+    key = '%s|%s' % (virtual_host, virtual_host.secure)
+
+    with _publishers_lock:
+        for closed in [l for l in _publishers if l.is_closed()]:
+            for publisher in _publishers.pop(closed).values():
+                publisher.abort()
+
+        publishers = _publishers.setdefault(loop, {})
+        if key not in publishers:
+            publishers[key] = AsyncPublisher(virtual_host, loop)
+
+        return publishers[key]
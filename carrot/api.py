@@ -16,7 +16,15 @@ class MessageLogSerializer(serializers.ModelSerializer):
         model = MessageLog
         fields = 'status', 'exchange', 'queue', 'routing_key', 'uuid', 'priority', 'task', 'task_args', \
                  'content', 'exception', 'traceback', 'output', 'publish_time', 'failure_time', 'completion_time', \
-                 'log', 'id', 'virtual_host'
+                 'log', 'id', 'virtual_host', 'publish_confirmed', 'truncated'
+
+
+class MessageLogDetailSerializer(MessageLogSerializer):
+    """
+    Includes the full log and output of the task, if they were truncated
+    """
+    log = serializers.CharField(source='full_log', read_only=True)
+    output = serializers.CharField(source='full_output', read_only=True)
 
 
 class SmallPagination(pagination.PageNumberPagination):
@@ -117,6 +125,7 @@ class MessageLogDetailViewset(MessageLogViewset):
     """
     Shows the detail of a single `MessageLog` object
     """
+    serializer_class = MessageLogDetailSerializer
     queryset = MessageLog.objects.all()
     kwargs: dict = {}
 
@@ -0,0 +1,159 @@
+"""
+This module implements claim-check offloading of large message bodies.
+
+If a queue defines a `claim_check_threshold`, message bodies larger than the threshold are written once to a blob store,
+and only a reference to the blob is sent to RabbitMQ (in the message headers) and saved to the
+:class:`carrot.models.MessageLog`. The consumer reads the body back from the store when the message is consumed, and the
+blob is deleted once the task has completed successfully, or when its MessageLog is deleted.
+
+Each blob starts with a short header containing the content type and content encoding of the body, so it can be decoded
+without the original message (e.g. when a failed task is requeued).
+
+Two stores are provided:
+
+- :class:`FileSystemStore` (the default): stores each blob as a file in a directory. Blobs are read with `mmap`, so they
+  are not copied into memory until they are decoded
+- :class:`DatabaseStore`: stores each blob as a :class:`carrot.models.Blob` object in the Django project's database
+
+"""
+import importlib
+import mmap
+import os
+from typing import Dict, Any, Tuple, Union, Optional
+
+from django.conf import settings
+
+from carrot.codecs import get_codec, get_compressor
+
+DEFAULT_CLAIM_CHECK_SETTINGS: Dict[str, Any] = {
+    'store': 'carrot.claimcheck.FileSystemStore',
+    'options': {},
+}
+
+Buffer = Union[bytes, memoryview]
+
+
+class BlobStore(object):
+    """
+    The base class for blob stores
+    """
+
+    def put(self, key: str, data: bytes) -> None:
+        raise NotImplementedError
+
+    def get(self, key: str) -> Buffer:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+
+class FileSystemStore(BlobStore):
+    """
+    Stores each blob as a file in the directory `path`. The directory must be shared by the publishers and consumers
+    """
+
+    def __init__(self, path: str = '/var/lib/carrot/blobs') -> None:
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.path, os.path.basename(key))
+
+    def put(self, key: str, data: bytes) -> None:
+        tmp = self._path(key) + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+
+    def get(self, key: str) -> Buffer:
+        with open(self._path(key), 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b''
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class DatabaseStore(BlobStore):
+    """
+    Stores each blob as a :class:`carrot.models.Blob` object
+    """
+
+    def put(self, key: str, data: bytes) -> None:
+        from carrot.models import Blob
+        Blob.objects.update_or_create(key=key, defaults={'data': data})
+
+    def get(self, key: str) -> Buffer:
+        from carrot.models import Blob
+        return Blob.objects.values_list('data', flat=True).get(key=key)
+
+    def delete(self, key: str) -> None:
+        from carrot.models import Blob
+        Blob.objects.filter(key=key).delete()
+
+
+_store: Optional[BlobStore] = None
+_store_config: Optional[Dict[str, Any]] = None
+
+
+def get_store() -> BlobStore:
+    """
+    Returns the blob store configured with the `claim_check` setting
+    """
+    global _store, _store_config
+
+    try:
+        conf = dict(DEFAULT_CLAIM_CHECK_SETTINGS, **settings.CARROT.get('claim_check', {}))
+    except AttributeError:
+        conf = DEFAULT_CLAIM_CHECK_SETTINGS
+
+    if _store is None or conf != _store_config:
+        module = '.'.join(conf['store'].split('.')[:-1])
+        store_class = getattr(importlib.import_module(module), conf['store'].split('.')[-1])
+        _store, _store_config = store_class(**conf['options']), conf
+
+    return _store
+
+
+def store_body(key: str, body: Union[str, bytes], content_type: str, content_encoding: str = None) -> str:
+    """
+    Writes a message body to the blob store, and returns the reference to send in its place
+    """
+    if isinstance(body, str):
+        body = body.encode()
+
+    header = ('%s\n%s\n' % (content_type, content_encoding or '')).encode()
+    get_store().put(key, header + body)
+    return key
+
+
+def load_body(ref: str) -> Tuple[Buffer, str, Optional[str]]:
+    """
+    Reads a message body from the blob store. Returns a tuple containing the body (without copying it, where the store
+    allows), its content type and its content encoding
+    """
+    data = get_store().get(ref)
+    content_type, content_encoding, _ = bytes(data[:512]).split(b'\n', 2)
+    offset = len(content_type) + len(content_encoding) + 2
+    return data[offset:], content_type.decode(), content_encoding.decode() or None
+
+
+def load_arguments(ref: str) -> Tuple[tuple, dict]:
+    """
+    Reads and decodes the task arguments stored in a blob
+    """
+    body, content_type, content_encoding = load_body(ref)
+    if content_encoding:
+        body = get_compressor(content_encoding).decompress(body)
+
+    content = get_codec(content_type).loads(body)
+    return tuple(content.get('args', ())), content.get('kwargs', {})
+
+
+def delete(ref: str) -> None:
+    get_store().delete(ref)
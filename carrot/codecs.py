@@ -0,0 +1,166 @@
+"""
+This module provides the codecs used to encode task arguments into RabbitMQ message bodies, and decode them again.
+
+Codecs are registered by their content type. Publishers choose a codec using the `serializer` option of each queue in
+`settings.CARROT['queues']`, and consumers choose the codec to decode each message with from the message's
+`content_type` property, so queues can be switched from one format to another without losing messages.
+
+The following codecs are provided:
+
+- **json** (`application/json`): the default
+- **msgpack** (`application/x-msgpack`): a compact binary format. Requires the `msgpack
+  <https://pypi.org/project/msgpack/>`_ package
+
+Encoded bodies may also be compressed. Compressors are registered by name, and the name of the compressor used is sent
+in the message's `content_encoding` property. The **zlib** and **lzma** compressors are provided
+
+"""
+import json
+import lzma
+import zlib
+from typing import Dict, Any, Union
+
+from carrot.exceptions import CarrotConfigException
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+class Codec(object):
+    """
+    The base class for codecs. Subclasses must define a `name` and `content_type`, and implement :meth:`dumps` and
+    :meth:`loads`
+    """
+    name: str = ''
+    content_type: str = ''
+
+    def dumps(self, data: Dict[str, Any]) -> Union[str, bytes]:
+        raise NotImplementedError
+
+    def loads(self, body: Union[str, bytes, memoryview]) -> Dict[str, Any]:
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    """
+    Encodes message bodies as compact JSON
+    """
+    name = 'json'
+    content_type = 'application/json'
+
+    def dumps(self, data: Dict[str, Any]) -> str:
+        return json.dumps(data, separators=(',', ':'))
+
+    def loads(self, body: Union[str, bytes, memoryview]) -> Dict[str, Any]:
+        if isinstance(body, memoryview):
+            # json cannot read from a buffer, so decode it straight to a string rather than copying it to bytes first
+            body = str(body, 'utf-8')
+        return json.loads(body)
+
+
+class MsgPackCodec(Codec):
+    """
+    Encodes message bodies with msgpack
+    """
+    name = 'msgpack'
+    content_type = 'application/x-msgpack'
+
+    def dumps(self, data: Dict[str, Any]) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, body: Union[str, bytes, memoryview]) -> Dict[str, Any]:
+        return msgpack.unpackb(body, raw=False)
+
+
+_codecs: Dict[str, Codec] = {}
+
+
+def register_codec(codec: Codec) -> None:
+    """
+    Registers a codec, so that it can be selected by its name or content type
+    """
+    _codecs[codec.content_type] = codec
+    _codecs[codec.name] = codec
+
+
+def get_codec(name: str = None) -> Codec:
+    """
+    Returns the codec registered with the given name or content type. If no name is given, the JSON codec is returned
+
+    May raise an exception if no matching codec has been registered
+    """
+    if not name:
+        return _codecs[JSONCodec.content_type]
+
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise CarrotConfigException('No serializer is registered for %s. Available serializers are: %s'
+                                    % (name, ', '.join(sorted(c.name for c in _codecs.values()))))
+
+
+class Compressor(object):
+    """
+    The base class for compressors. The `name` is sent in the `content_encoding` property of compressed messages
+    """
+    name: str = ''
+
+    def compress(self, body: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, body: bytes) -> bytes:
+        raise NotImplementedError
+
+
+class ZlibCompressor(Compressor):
+    name = 'zlib'
+
+    def compress(self, body: bytes) -> bytes:
+        return zlib.compress(body)
+
+    def decompress(self, body: bytes) -> bytes:
+        return zlib.decompress(body)
+
+
+class LzmaCompressor(Compressor):
+    name = 'lzma'
+
+    def compress(self, body: bytes) -> bytes:
+        return lzma.compress(body)
+
+    def decompress(self, body: bytes) -> bytes:
+        return lzma.decompress(body)
+
+
+_compressors: Dict[str, Compressor] = {}
+
+
+def register_compressor(compressor: Compressor) -> None:
+    """
+    Registers a compressor, so that it can be selected by its name
+    """
+    _compressors[compressor.name] = compressor
+
+
+def get_compressor(name: str) -> Compressor:
+    """
+    Returns the compressor registered with the given name
+
+    May raise an exception if no matching compressor has been registered
+    """
+    try:
+        return _compressors[name]
+    except KeyError:
+        raise CarrotConfigException('No compressor is registered for %s. Available compressors are: %s'
+                                    % (name, ', '.join(sorted(_compressors))))
+
+
+register_codec(JSONCodec())
+
+if msgpack:
+    register_codec(MsgPackCodec())
+
+register_compressor(ZlibCompressor())
+register_compressor(LzmaCompressor())
@@ -0,0 +1,433 @@
+"""
+This module provides a pool of reusable publisher connections for each :class:`carrot.objects.VirtualHost`.
+
+Publishing a message used to open a new :class:`pika.BlockingConnection`, and close it again after a single
+`basic_publish`. The :class:`ConnectionPool` keeps these connections (and their channels) open between publishes instead,
+so that the TCP and AMQP handshakes only happen once per connection, rather than once per message
+
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Iterator, Tuple, Callable, Any, Optional, Union, Set
+
+import pika
+from pika.exceptions import AMQPError, AMQPConnectionError, ChannelClosed, ConnectionClosed
+from django.conf import settings
+
+from carrot.objects import VirtualHost
+
+logger = logging.getLogger('carrot')
+
+RECOVERABLE_ERRORS = (AMQPConnectionError, ChannelClosed, ConnectionClosed)
+
+DEFAULT_CONFIRM_SETTINGS: Dict[str, Any] = {
+    'enabled': False,
+    'max_in_flight': 1000,
+    'batch_size': 100,
+    'timeout': 30,
+    'release_timeout': 1,
+}
+
+
+class ConfirmTimeout(AMQPError):
+    """
+    Raised when a message cannot be published because `max_in_flight` messages have been waiting for confirmation for
+    longer than the confirm `timeout`
+    """
+    pass
+
+
+class ConfirmChannel(object):
+    """
+    Wraps a :class:`pika.BlockingConnection` channel in publisher confirm mode.
+
+    Pika's own confirm mode waits for the broker to confirm each message before `basic_publish` returns, which costs a
+    network round trip per message. This class instead publishes without waiting, and keeps track of the outstanding
+    delivery tags. Confirmations (including `multiple=True` acknowledgements, which confirm every outstanding tag up to
+    and including the given one) are resolved whenever the connection processes its incoming frames, and the
+    corresponding :class:`carrot.models.MessageLog` objects are updated in batches. Before the channel is returned to
+    its pool, outstanding confirmations are waited for for up to `release_timeout` seconds, so that they are recorded
+    even if the channel is not used again for a while.
+
+    Messages published with `mandatory=True` that cannot be routed to a queue are returned by the broker, and then
+    acknowledged. These are recorded as not confirmed.
+
+    At most `max_in_flight` messages may be unconfirmed at once; further publishes wait for confirmations first, and
+    raise :class:`ConfirmTimeout` if none arrive within the `timeout`.
+
+    All other attributes are passed through to the wrapped channel
+    """
+
+    def __init__(self, connection: pika.BlockingConnection, channel: pika.channel.Channel, max_in_flight: int = None,
+                 batch_size: int = None, timeout: int = None, release_timeout: float = None) -> None:
+        self.connection = connection
+        self.channel = channel
+        self.max_in_flight = max_in_flight or DEFAULT_CONFIRM_SETTINGS['max_in_flight']
+        self.batch_size = batch_size or DEFAULT_CONFIRM_SETTINGS['batch_size']
+        self.timeout = timeout or DEFAULT_CONFIRM_SETTINGS['timeout']
+        self.release_timeout = (DEFAULT_CONFIRM_SETTINGS['release_timeout'] if release_timeout is None
+                                else release_timeout)
+
+        self.delivery_tag = 0
+        self.outstanding: 'OrderedDict[int, str]' = OrderedDict()
+        self.acked: List[str] = []
+        self.nacked: List[str] = []
+        # the message ids of the messages that have been returned as unroutable, but not yet acknowledged
+        self.returned: Set[str] = set()
+
+        # nowait means that there is no need to block on a Confirm.SelectOk reply
+        self.channel._impl.confirm_delivery(callback=self.on_confirm, nowait=True)
+        self.channel._impl.add_on_return_callback(self.on_return)
+
+    def __getattr__(self, item: str) -> Any:
+        return getattr(self.channel, item)
+
+    def basic_publish(self, exchange: str, routing_key: str, body: Union[str, bytes],
+                      properties: pika.BasicProperties = None, mandatory: bool = False,
+                      immediate: bool = False) -> None:
+        """
+        Publishes a message without waiting for it to be confirmed. The message id of the properties is used to identify
+        the message's MessageLog
+        """
+        deadline = time.monotonic() + self.timeout
+        while len(self.outstanding) >= self.max_in_flight:
+            if time.monotonic() >= deadline:
+                logger.warning('%i messages have not been confirmed by the broker after %s seconds'
+                               % (len(self.outstanding), self.timeout))
+                raise ConfirmTimeout('Unable to publish the message, as the maximum of %i unconfirmed messages has '
+                                     'been reached' % self.max_in_flight)
+            self.connection.process_data_events(time_limit=0.01)
+
+        self.channel._impl.basic_publish(exchange=exchange, routing_key=routing_key, body=body,
+                                         properties=properties, mandatory=mandatory, immediate=immediate)
+        self.delivery_tag += 1
+        self.outstanding[self.delivery_tag] = properties.message_id if properties else None
+
+        # sends the message, and handles any confirmations that have already arrived
+        self.connection.process_data_events(time_limit=0)
+
+        if len(self.acked) + len(self.nacked) >= self.batch_size:
+            self.save_confirmations()
+
+    def on_confirm(self, method_frame: pika.frame.Method) -> None:
+        """
+        Invoked by pika when the broker sends a Basic.Ack or Basic.Nack
+        """
+        method = method_frame.method
+        uuids = []
+
+        if method.multiple:
+            while self.outstanding and next(iter(self.outstanding)) <= method.delivery_tag:
+                uuids.append(self.outstanding.popitem(last=False)[1])
+        elif method.delivery_tag in self.outstanding:
+            uuids.append(self.outstanding.pop(method.delivery_tag))
+
+        for uuid in uuids:
+            # the broker acknowledges messages that it has returned, but they did not reach a queue
+            if isinstance(method, pika.spec.Basic.Ack) and uuid not in self.returned:
+                self.acked.append(uuid)
+            else:
+                self.nacked.append(uuid)
+            self.returned.discard(uuid)
+
+    def on_return(self, channel: pika.channel.Channel, method: pika.spec.Basic.Return,
+                  properties: pika.BasicProperties, body: bytes) -> None:
+        """
+        Invoked by pika when the broker returns a message that was published with `mandatory=True`, but could not be
+        routed to any queue. The broker sends the message's confirmation afterwards
+        """
+        logger.warning('A message was returned by the broker as it could not be routed: %s %s'
+                       % (method.reply_code, method.reply_text))
+        if properties and properties.message_id:
+            self.returned.add(properties.message_id)
+
+    def save_confirmations(self) -> None:
+        """
+        Writes the confirmations received so far to the MessageLogs, using one query per batch
+        """
+        from carrot.models import MessageLog
+
+        for uuids, confirmed in ((self.acked, True), (self.nacked, False)):
+            uuids = [uuid for uuid in uuids if uuid]
+            if not confirmed and uuids:
+                logger.warning('%i messages were rejected or returned by the broker' % len(uuids))
+
+            for i in range(0, len(uuids), self.batch_size):
+                MessageLog.objects.filter(uuid__in=uuids[i:i + self.batch_size]).update(publish_confirmed=confirmed)
+
+        self.acked, self.nacked = [], []
+
+    def wait_for_confirms(self, timeout: int = None) -> bool:
+        """
+        Waits up to `timeout` seconds for every outstanding message to be confirmed, and saves the confirmations.
+        Returns True if no messages are still outstanding
+        """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        while self.outstanding and time.monotonic() < deadline:
+            self.connection.process_data_events(time_limit=0.01)
+
+        self.save_confirmations()
+        return not self.outstanding
+
+
+class PooledConnection(object):
+    """
+    A single connection held by a :class:`ConnectionPool`, along with the channel that is used to publish with it
+    """
+
+    def __init__(self, virtual_host: VirtualHost, confirms: Dict[str, Any] = None) -> None:
+        self.connection: pika.BlockingConnection = virtual_host.blocking_connection
+        self.channel: Union[pika.channel.Channel, ConfirmChannel] = self.connection.channel()
+        self.last_used = time.monotonic()
+
+        if confirms and confirms.get('enabled'):
+            self.channel = ConfirmChannel(self.connection, self.channel, max_in_flight=confirms.get('max_in_flight'),
+                                          batch_size=confirms.get('batch_size'), timeout=confirms.get('timeout'),
+                                          release_timeout=confirms.get('release_timeout'))
+
+    @property
+    def is_healthy(self) -> bool:
+        """
+        Returns True if the connection and its channel are still open. Any pending frames (e.g. heartbeats) are
+        processed, so that a connection which has been dropped by the broker is detected before it gets used
+        """
+        try:
+            if not self.connection.is_open or not self.channel.is_open:
+                return False
+
+            self.connection.process_data_events(time_limit=0)
+        except AMQPError:
+            return False
+
+        return True
+
+    def close(self) -> None:
+        """
+        Closes the connection, ignoring any errors caused by the connection already being closed. In confirm mode, any
+        outstanding confirmations are waited for first
+        """
+        try:
+            if isinstance(self.channel, ConfirmChannel):
+                self.channel.wait_for_confirms()
+
+            self.connection.close()
+        except AMQPError:
+            pass
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of :class:`PooledConnection` objects belonging to a single :class:`carrot.objects.VirtualHost`
+
+    Connections are checked out exclusively by a single thread at a time, as pika's blocking connections are not
+    thread-safe. At most `max_size` connections are open at any time; further callers wait for a connection to be
+    returned to the pool. Connections that have not been used for `max_idle` seconds are closed and evicted.
+
+    The pool is also fork-safe: if the process id changes, the connections inherited from the parent are abandoned
+    (without being closed, as the socket still belongs to the parent) and new connections are created on demand
+
+    :param virtual_host: the host to connect to
+    :type virtual_host: :class:`carrot.objects.VirtualHost`
+    :param int max_size: the maximum number of connections held by the pool
+    :param int max_idle: the number of seconds after which an unused connection is closed
+    :param dict confirms: the publisher confirm settings. If enabled, each channel is wrapped in a
+        :class:`ConfirmChannel`
+
+    """
+    max_size: int = 10
+    max_idle: int = 300
+
+    def __init__(self, virtual_host: VirtualHost, max_size: int = None, max_idle: int = None,
+                 confirms: Dict[str, Any] = None) -> None:
+        self.virtual_host = virtual_host
+        self.confirms = confirms
+
+        if max_size is not None:
+            self.max_size = max_size
+
+        if max_idle is not None:
+            self.max_idle = max_idle
+
+        self._reset()
+
+    def _reset(self) -> None:
+        self._pid = os.getpid()
+        self._condition = threading.Condition()
+        self._idle: List[PooledConnection] = []
+        self._size = 0
+
+    def _check_pid(self) -> None:
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _evict_idle(self) -> List[PooledConnection]:
+        """
+        Removes the connections that have not been used for longer than `self.max_idle` from the pool, and returns them.
+        Must be called while holding the pool's lock. The connections must be closed once the lock has been released,
+        as closing a connection can block (e.g. while waiting for publisher confirms)
+        """
+        cutoff = time.monotonic() - self.max_idle
+        expired = [c for c in self._idle if c.last_used < cutoff]
+        for conn in expired:
+            self._idle.remove(conn)
+            self._size -= 1
+        return expired
+
+    def _discard(self, conn: PooledConnection) -> None:
+        """
+        Removes a checked out connection from the pool, and closes it outside of the pool's lock
+        """
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+        conn.close()
+
+    def acquire(self) -> PooledConnection:
+        """
+        Checks out a healthy connection from the pool, creating a new one if none are available and the pool has not
+        reached its maximum size. The pool's lock is not held while connections are checked or closed, as both involve
+        network I/O
+        """
+        self._check_pid()
+
+        while True:
+            with self._condition:
+                expired = self._evict_idle()
+                conn = self._idle.pop() if self._idle else None
+                create = conn is None and self._size < self.max_size
+
+                if create:
+                    self._size += 1
+                elif conn is None and not expired:
+                    self._condition.wait()
+                    continue
+
+            for expired_conn in expired:
+                expired_conn.close()
+
+            if create:
+                break
+
+            if conn is not None:
+                if conn.is_healthy:
+                    return conn
+                self._discard(conn)
+
+        try:
+            return PooledConnection(self.virtual_host, self.confirms)
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, conn: PooledConnection, discard: bool = False) -> None:
+        """
+        Returns a connection to the pool. If `discard` is True, or if the connection was created by a different process,
+        the connection is dropped instead
+        """
+        if self._pid != os.getpid():
+            return
+
+        if discard:
+            return self._discard(conn)
+
+        with self._condition:
+            conn.last_used = time.monotonic()
+            self._idle.append(conn)
+            self._condition.notify()
+
+    @contextmanager
+    def channel(self) -> Iterator[Tuple[pika.BlockingConnection, pika.channel.Channel]]:
+        """
+        A context manager that yields a connection and channel from the pool, and returns them afterwards. If an AMQP
+        error is raised, the connection is discarded rather than being returned to the pool. In confirm mode, the
+        confirmations for the messages published on the channel are waited for (for up to the `release_timeout`) and
+        saved before it is returned
+        """
+        conn = self.acquire()
+        discard = False
+        try:
+            yield conn.connection, conn.channel
+
+            if isinstance(conn.channel, ConfirmChannel):
+                conn.channel.wait_for_confirms(conn.channel.release_timeout)
+        except AMQPError:
+            discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def execute(self, func: Callable[[pika.BlockingConnection, pika.channel.Channel], Any], retries: int = 1) -> Any:
+        """
+        Calls `func` with a pooled connection and channel. If the connection turns out to have been closed, it is
+        discarded, and the call is retried with a new connection up to `retries` times
+        """
+        for attempt in range(0, retries + 1):
+            try:
+                with self.channel() as (connection, channel):
+                    return func(connection, channel)
+            except RECOVERABLE_ERRORS:
+                if attempt >= retries:
+                    raise
+
+    def close(self) -> None:
+        """
+        Closes all idle connections held by the pool
+        """
+        self._check_pid()
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+
+        for conn in idle:
+            conn.close()
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def pool_key(virtual_host: VirtualHost) -> str:
+    """
+    Returns the key of the :class:`ConnectionPool` for the given virtual host. Hosts that differ only in whether they
+    use SSL have separate pools
+    """
+    return '%s|%s' % (virtual_host, virtual_host.secure)
+
+
+def get_pool(virtual_host: VirtualHost) -> ConnectionPool:
+    """
+    Returns the :class:`ConnectionPool` for the given virtual host, creating it if required. The pool size and idle
+    timeout can be configured with the `publisher_pool` setting, and publisher confirms with `publisher_confirms`
+    """
+    key = pool_key(virtual_host)
+    pool: Optional[ConnectionPool] = _pools.get(key)
+    if pool:
+        return pool
+
+    try:
+        conf = settings.CARROT.get('publisher_pool', {})
+        confirms = dict(DEFAULT_CONFIRM_SETTINGS, **settings.CARROT.get('publisher_confirms', {}))
+    except AttributeError:
+        conf, confirms = {}, DEFAULT_CONFIRM_SETTINGS
+
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(virtual_host, max_size=conf.get('max_size', None),
+                                         max_idle=conf.get('max_idle', None), confirms=confirms)
+        return _pools[key]
+
+
+def close_pools() -> None:
+    """
+    Closes the idle connections of every pool, e.g. on shutdown
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
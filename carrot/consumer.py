@@ -3,25 +3,68 @@ This module provides a backend API for creating Consumers and Consumer Sets
 
 """
 
-from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.db.utils import OperationalError
+from django.db import connections
 from django.conf import settings
 
 from carrot.models import MessageLog
-from carrot.objects import VirtualHost, BaseMessageSerializer, DefaultMessageSerializer
-
+from carrot.objects import VirtualHost, BaseMessageSerializer, DefaultMessageSerializer, get_task_arguments
+from carrot.exceptions import CarrotConfigException, SoftTimeLimitExceeded
+from carrot.utilities import get_queue_settings
+from carrot.aio import run_sync
+from carrot.connections import get_pool
+from carrot.tasklog import LOGGING_FORMAT, TaskLog
+from carrot import outbox, claimcheck, logwriter, tasklog, metrics, ratelimit
+
+import asyncio
+import collections
+import contextlib
+import ctypes
+import functools
 import json
+import queue as queue_module
 import traceback
 import threading
 import logging
 import importlib
+import multiprocessing
+import os
+import signal
+import sys
 import pika
 import time
-from typing import Optional, Type, List, Dict, Any, Callable, Union
+from typing import Optional, Type, List, Dict, Any, Callable, Union, Tuple, Iterator
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+
+ACK_MODES = ('early', 'late')
+
+WORKER_TYPES = ('thread', 'process')
+
+
+def get_rss() -> int:
+    """
+    Returns the resident set size of the current process, in bytes. On platforms without `/proc`, the peak resident
+    set size is returned instead
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
 
+    if resource is None:
+        return 0
 
-LOGGING_FORMAT = '%(threadName)-10s %(asctime)-10s %(levelname)s:: %(message)s'
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is measured in bytes on macOS, and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
 
 
 # noinspection PyUnusedLocal,PyUnresolvedReferences
@@ -30,28 +73,45 @@ class Consumer(threading.Thread):
     An individual Consumer object. This class is run on a detached thread and watches a specific RabbitMQ queue for
     messages, and consumes them when they appear. Multiple Consumers can be linked to the same queue using a
     :class:`.ConsumerSet` object.
+
+    The consumer's thread runs the connection's I/O loop, which receives and acknowledges messages. Tasks are run on a
+    separate worker thread, so that long running tasks do not block heartbeats, acknowledgements or cancellations, and
+    the next messages (up to the prefetch count) can be received while a task is running
     """
 
     serializer: Type[BaseMessageSerializer] = DefaultMessageSerializer
     reconnect_timeout: int = 5
-    task_log: List[str] = []
     exchange_arguments: Dict[str, Any] = {}
-    active_message_log: Optional[MessageLog] = None
+    active_task: Optional[multiprocessing.Array] = None
+    task_deadline: Optional[multiprocessing.Value] = None
+    _active_message_log: Optional[MessageLog] = None
+    _deadline: float = 0
     remaining_save_attempts: int = 10
     get_message_attempts: int = 50
+    ack_interval: float = 1
 
     def __init__(self, host: VirtualHost, queue: str, logger: logging.Logger, name: str, durable: bool = True,
-                 queue_arguments: dict = None, exchange_arguments: dict = None):
+                 queue_arguments: dict = None, exchange_arguments: dict = None, prefetch_count: int = 1,
+                 ack_mode: str = 'early', shared_connection: 'ConsumerConnection' = None):
         """
         :param host: the host the queue to consume from is attached to
         :type host: :class:`carrot.objects.VirtualHost`
         :param str queue: the queue to consume from
         :param logger: the logging object
         :param name: the name of the consumer
+        :param int prefetch_count: the number of unacknowledged messages RabbitMQ may deliver to the consumer at once
+        :param str ack_mode: **early** to acknowledge each message as soon as it is received, or **late** to
+            acknowledge it once the task has finished, so that it is redelivered if the worker dies while it is running
+        :param shared_connection: if provided, the consumer opens a channel on this connection instead of opening its
+            own connection. Messages are received on the connection's thread, and consumed on the consumer's thread
+        :type shared_connection: :class:`.ConsumerConnection`
 
         """
         super().__init__()
 
+        if ack_mode not in ACK_MODES:
+            raise CarrotConfigException('Invalid ack_mode %s. Must be one of: %s' % (ack_mode, ', '.join(ACK_MODES)))
+
         if queue_arguments is None:
             queue_arguments = {}
 
@@ -61,9 +121,23 @@ class Consumer(threading.Thread):
         self.failure_callbacks: List[Callable] = []
         self.name = name
         self.logger = logger
+        self.task_log: List[str] = []
+        self.running = 0
         self.queue = queue
         self.exchange = queue
 
+        queue_settings = get_queue_settings(self.queue)
+        self.time_limit: Optional[float] = queue_settings.get('time_limit', None)
+        self.soft_time_limit: Optional[float] = queue_settings.get('soft_time_limit', None)
+        self.abandoned = False
+        self._time_limit_lock = threading.Lock()
+        self.max_tasks_per_worker: Optional[int] = queue_settings.get('max_tasks_per_worker', None)
+        self.max_memory_per_worker: Optional[float] = queue_settings.get('max_memory_per_worker', None)
+        self.tasks_completed = 0
+        self.recycled = False
+        rate_limit = queue_settings.get('rate_limit', None)
+        self.rate_limit: Optional[float] = ratelimit.parse_rate(rate_limit) if rate_limit else None
+
         self.connection: pika.SelectConnection = None
         self.channel: pika.channel = None
         self.shutdown_requested = False
@@ -74,37 +148,154 @@ class Consumer(threading.Thread):
         self.exchange_arguments = exchange_arguments
         self.durable = durable
 
+        self.prefetch_count = prefetch_count
+        self.ack_mode = ack_mode
+        self.ack_batch_size = max(1, prefetch_count // 2)
+        self.redelivered = False
+        self._unacked_tag: Optional[int] = None
+        self._unacked_count = 0
+        self._ack_timeout = None
+        # the delivery tags of the messages received on the current channel that have not been acknowledged yet, and
+        # whether they have finished, in **late** ack mode
+        self._outstanding: collections.OrderedDict = collections.OrderedDict()
+        # the messages that have been delayed by a rate limit, and have already taken their token
+        self._rate_limited: set = set()
+
+        self.shared_connection = shared_connection
+        self.worker: Optional[threading.Thread] = None
+        # messages waiting for the worker thread. Messages are only acknowledged once the worker has taken them, so
+        # the size of the queue is bounded by the prefetch count
+        self.messages: queue_module.Queue = queue_module.Queue()
+
+        if outbox.is_enabled():
+            # messages are only published once their MessageLog has been committed, so there is no need to poll for it
+            self.get_message_attempts = 1
+
+    @property
+    def active_message_log(self) -> Optional[MessageLog]:
+        return self._active_message_log
+
+    @active_message_log.setter
+    def active_message_log(self, log: Optional[MessageLog]) -> None:
+        """
+        Sets the MessageLog of the task being consumed. When the consumer is run by a :class:`.ConsumerProcess`, its
+        uuid is also shared with the parent process, so that the task can be marked as failed if the process dies
+        """
+        self._active_message_log = log
+        if self.active_task is not None:
+            self.active_task.value = str(log.uuid).encode() if log else b''
+
+    @property
+    def deadline(self) -> float:
+        return self._deadline
+
+    @deadline.setter
+    def deadline(self, deadline: float) -> None:
+        """
+        Sets the time (as a timestamp) at which the running task exceeds its hard time limit, or 0 if it has no limit.
+        When the consumer is run by a :class:`.ConsumerProcess`, it is also shared with the parent process
+        """
+        self._deadline = deadline
+        if self.task_deadline is not None:
+            self.task_deadline.value = deadline
+
+    @contextlib.contextmanager
+    def time_limits(self, func: Callable) -> Iterator[None]:
+        """
+        Applies the time limits of a task (see :func:`carrot.utilities.time_limit`) to the code run inside the block,
+        which must be run on the worker thread. The soft limit raises :class:`carrot.exceptions.SoftTimeLimitExceeded`
+        inside the task. The hard limit is enforced by :meth:`.ConsumerSet.check_time_limits`
+        """
+        hard = getattr(func, 'carrot_time_limit', None) or self.time_limit
+        soft = getattr(func, 'carrot_soft_time_limit', None) or self.soft_time_limit
+        timer = None
+        active = [True]
+        thread_id = threading.get_ident()
+
+        def interrupt() -> None:
+            with self._time_limit_lock:
+                if active[0]:
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id),
+                                                               ctypes.py_object(SoftTimeLimitExceeded))
+
+        if soft:
+            timer = threading.Timer(soft, interrupt)
+            timer.daemon = True
+            timer.start()
+
+        self.deadline = time.time() + hard if hard else 0
+
+        try:
+            yield
+        finally:
+            # the soft limit may expire just as the block exits, in which case its exception can be raised here, rather
+            # than in the task. The timer only fires once, so once it has been disabled and any exception it has
+            # injected has been discarded, the rest of the clean up can't be interrupted
+            try:
+                with self._time_limit_lock:
+                    active[0] = False
+                    if timer:
+                        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id), None)
+            except SoftTimeLimitExceeded:
+                pass
+
+            if timer:
+                timer.cancel()
+            self.deadline = 0
+
+    def abandon(self, reason: str) -> None:
+        """
+        Gives up on a task that has exceeded its hard time limit. Its MessageLog is marked as failed, with the stack of
+        the worker thread as the traceback, and the consumer is stopped without waiting for the worker thread, which
+        can't be killed. If the task ever finishes, its result is discarded
+        """
+        log = self.active_message_log
+        # consumers on a shared connection run their tasks on their own thread
+        frame = sys._current_frames().get((self.worker or self).ident)
+        tb = ''.join(traceback.format_stack(frame)) if frame else ''
+
+        if log:
+            self.fail(log, reason, tb=tb)
+
+        self.abandoned = True
+        self.deadline = 0
+        self.stop()
+
     def add_failure_callback(self, cb: Callable) -> None:
         """
         Registers a callback that gets called when there is any kind of error with the `.consume()` method
         """
         self.failure_callbacks.append(cb)
 
-    def fail(self, log: MessageLog, err: Union[str, Exception]) -> None:
+    def fail(self, log: MessageLog, err: Union[str, Exception], task_log: List[str] = None, tb: str = None) -> None:
         """
         This function is called whenever there is a failure executing a specific `MessageLog` object
 
-        The exception message is logged, and the MessageLog is updated with the result
+        The exception message is logged, and the MessageLog is updated with the result. The `task_log` and traceback
+        `tb` default to the consumer's task log and the exception currently being handled
 
         """
+        if task_log is None:
+            task_log = self.task_log
+
         self.logger.error('Task %s failed due to the following exception: %s' % (log.task, err))
 
         for cb in self.failure_callbacks:
             try:
                 cb(log, err)
-                self.task_log.append('Failure callback %s succeeded' % str(cb))
+                task_log.append('Failure callback %s succeeded' % str(cb))
             except Exception as error:
-                self.task_log.append('Failure callback %s failed due to an error: %s' % (str(cb), error))
+                task_log.append('Failure callback %s failed due to an error: %s' % (str(cb), error))
 
-        if log.pk:
-            if self.task_log:
-                log.log = '\n'.join(self.task_log)
+        if log.pk or log.log_policy != 'full':
+            if task_log:
+                log.log = '\n'.join(task_log)
 
             log.status = 'FAILED'
             log.failure_time = timezone.now()
             log.exception = err
-            log.traceback = traceback.format_exc()
-            log.save()
+            log.traceback = tb if tb is not None else traceback.format_exc()
+            self.save_log(log, ['status', 'failure_time', 'exception', 'traceback', 'log'])
 
     def get_task_type(self, properties: pika.spec.BasicProperties, body: bytes) -> str:
         """
@@ -128,10 +319,12 @@ class Consumer(threading.Thread):
 
     def get_message_log(self, properties: pika.spec.BasicProperties, body: bytes) -> Optional[MessageLog]:
         """
-        Finds a MessageLog based on the content of the RabbitMQ message
+        Finds a MessageLog based on the content of the RabbitMQ message, and claims it for this consumer by marking it
+        as in progress
 
         By default, carrot finds this retrieving the MessageLog UUID from the RabbitMQ message properties.message_id
-        attribute.
+        attribute, and claims it with :meth:`carrot.models.MessageLog.claim`. If the MessageLog has already been
+        claimed, e.g. because the message was delivered twice, None is returned, so the task is never run twice
 
         This method can be extended by custom consumers. For example, if you are attempting to consume from a RabbitMQ
         queue containing messages that do not come from your Carrot instance, you may want to extend this method to
@@ -151,16 +344,69 @@ class Consumer(threading.Thread):
             implementing a custom consumer, then you should use
             `dead letter exchange <http://www.rabbitmq.com/dlx.html>`_ to preserve your message content
 
+        If the message was published to a queue with a `log_policy` other than **full**, no MessageLog was created, so
+        an unsaved one is returned instead (see :meth:`build_message_log`)
+
         """
-        try:
-            log = MessageLog.objects.get(uuid=properties.message_id)
-        except ObjectDoesNotExist:
-            return None
+        if self.serializer.log_header in (properties.headers or {}):
+            return self.build_message_log(properties, body)
 
-        if log.status == 'PUBLISHED':
-            return log
+        statuses = ['PUBLISHED']
+        if self.ack_mode == 'late' and self.redelivered:
+            # the message was not acknowledged because the worker running it died, so the task needs to be run again
+            statuses.append('IN_PROGRESS')
 
-        return None
+        logs = MessageLog.claim([properties.message_id], statuses)
+        return logs[0] if logs else None
+
+    def build_message_log(self, properties: pika.spec.BasicProperties, body: bytes) -> MessageLog:
+        """
+        Creates an unsaved MessageLog for a message that was published without one, from the details in its headers.
+        The MessageLog is only saved if its log policy requires it (see :meth:`save_log`)
+        """
+        headers = properties.headers
+        details = headers[self.serializer.log_header]
+        log = MessageLog(status='PUBLISHED', queue=self.queue, exchange=details.get('exchange', ''),
+                         routing_key=details.get('routing_key', self.queue), uuid=str(properties.message_id),
+                         priority=properties.priority or 0, task=headers.get(self.serializer.type_header, ''),
+                         claim_check=headers.get(self.serializer.claim_check_header, None),
+                         publish_time=parse_datetime(details.get('publish_time', '')))
+        log.log_policy = details['policy']
+        return log
+
+    def save_log(self, log: MessageLog, fields: List[str]) -> None:
+        """
+        Saves the given fields of a MessageLog (see :func:`carrot.logwriter.save`). MessageLogs that were not created
+        when the message was published are only saved if the task has failed and the log policy is
+        **failures_only**. Otherwise, the arguments of a failed task are removed from the blob store, as the task cannot
+        be requeued
+
+        Logs and outputs that are larger than the `log_storage` limits are truncated first (see
+        :func:`carrot.tasklog.limit`)
+        """
+        if self.abandoned:
+            # the MessageLog was marked as failed when the task exceeded its time limit
+            return
+
+        if log.pk or log.log_policy == 'full':
+            return logwriter.save(log, list(fields) + tasklog.limit(log, fields))
+
+        if log.status == 'FAILED':
+            if log.log_policy == 'failures_only':
+                tasklog.limit(log, fields)
+                log.save()
+            elif log.claim_check:
+                claimcheck.delete(log.claim_check)
+
+    @staticmethod
+    def record_arguments(log: MessageLog, args: tuple, kwargs: dict) -> None:
+        """
+        Adds the task arguments to a MessageLog that was not created when the message was published, so that the task
+        can be requeued if it fails
+        """
+        if log.pk is None and not log.claim_check:
+            log.task_args = str(tuple(args))
+            log.content = json.dumps(kwargs)
 
     def connect(self) -> pika.SelectConnection:
         """
@@ -191,6 +437,9 @@ class Consumer(threading.Thread):
         """
 
         self.channel = None
+        self._unacked_tag = None
+        self._unacked_count = 0
+        self._ack_timeout = None
         if self.shutdown_requested:
             self.logger.warning('Connection closed')
             self.connection.ioloop.stop()
@@ -214,7 +463,12 @@ class Consumer(threading.Thread):
         This function is invoked when the channel is established. It adds a callback in case of channel closure, and
         establishes the exchange
         """
+        if self.shutdown_requested:
+            channel.close()
+            return
+
         self.logger.info('Channel opened')
+        self._outstanding = collections.OrderedDict()
         self.channel = channel
         self.channel.add_on_close_callback(self.on_channel_closed)
         self.channel.exchange_declare(self.on_exchange_declare, self.exchange, **self.exchange_arguments)
@@ -225,6 +479,9 @@ class Consumer(threading.Thread):
 
         Parameters are require to match the signature used by Pika but are not required by Carrot
         """
+        if self.shared_connection:
+            return self.on_shared_channel_closed(reply_text)
+
         if not self.shutdown_requested:
             self.logger.warning('Consumer %s not running: %s' % (self.name, reply_text))
 
@@ -233,6 +490,29 @@ class Consumer(threading.Thread):
 
         self.connection.close()
 
+    def on_shared_channel_closed(self, reply_text: str) -> None:
+        """
+        Called when the channel is closed, if the consumer uses a shared connection. The connection is left open for the
+        other consumers. If the shutdown was not requested, the channel is reopened, either by the consumer (if the
+        connection is still open) or by the connection once it has reconnected
+        """
+        self.shared_connection.channel_closed(self)
+        self.channel = None
+        self._unacked_tag = None
+        self._unacked_count = 0
+        self._ack_timeout = None
+
+        if self.shutdown_requested:
+            self.logger.warning('Channel closed by client')
+            self.messages.put(None)
+
+        else:
+            self.logger.warning('Consumer %s not running: %s. Trying again in %i seconds'
+                                % (self.name, reply_text, self.reconnect_timeout))
+            if self.connection.is_open:
+                self.connection.add_timeout(self.reconnect_timeout,
+                                            functools.partial(self.shared_connection.open_channel, self))
+
     def on_exchange_declare(self, *args) -> None:
         """
         Invoked when the exchange has been successfully established
@@ -264,11 +544,11 @@ class Consumer(threading.Thread):
         """
         The main consumer process. Attaches a callback to be invoked whenever there is a new message added to the queue.
 
-        This method sets a channel prefetch count of zero to prevent dropouts
+        The channel prefetch count is set from the queue's `prefetch_count` setting (1 by default)
         """
         self.logger.info('Starting consumer %s' % self.name)
         self.channel.add_on_cancel_callback(self.on_consumer_cancelled)
-        self.channel.basic_qos(prefetch_count=1)
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
         self._consumer_tag = self.channel.basic_consume(self.on_message, self.queue)
 
     def on_consumer_cancelled(self, method_frame: pika.frame.Method) -> None:
@@ -280,19 +560,144 @@ class Consumer(threading.Thread):
         if self.channel:
             self.channel.close()
 
+    def ack(self, delivery_tag: int, channel: pika.channel.Channel = None) -> None:
+        """
+        Acknowledges a message. Must be called from the I/O loop's thread.
+
+        In **late** ack mode, acknowledgements are coalesced: a single `basic_ack` with `multiple=True` acknowledges
+        every message received up to and including the given one. As messages may finish out of order (e.g. if they
+        are delayed by a rate limit, or run concurrently by an :class:`.AsyncConsumer`), a message is only acknowledged
+        once every message received before it has finished too. Pending acknowledgements are sent once half the
+        prefetch count has built up, or after `ack_interval` seconds, whichever comes first
+
+        If the message was received on a different `channel` to the current one, it is not acknowledged, as RabbitMQ
+        will already have redelivered it
+        """
+        if channel is not None and channel is not self.channel:
+            return
+
+        if self.ack_mode == 'early':
+            self.channel.basic_ack(delivery_tag)
+            return
+
+        self._outstanding[delivery_tag] = True
+        finished = None
+
+        while self._outstanding and next(iter(self._outstanding.values())):
+            finished, _ = self._outstanding.popitem(last=False)
+
+        if finished is None:
+            return
+
+        self._unacked_tag = finished
+        self._unacked_count += 1
+
+        if self._unacked_count >= self.ack_batch_size:
+            self.flush_acks()
+        elif self._ack_timeout is None:
+            self._ack_timeout = self.connection.add_timeout(self.ack_interval, self.on_ack_timeout)
+
+    def on_ack_timeout(self) -> None:
+        self._ack_timeout = None
+        self.flush_acks()
+
+    def flush_acks(self) -> None:
+        """
+        Sends any pending acknowledgements to RabbitMQ
+        """
+        if self._ack_timeout is not None:
+            self.connection.remove_timeout(self._ack_timeout)
+            self._ack_timeout = None
+
+        if self._unacked_tag is not None and self.channel and self.channel.is_open:
+            self.channel.basic_ack(self._unacked_tag, multiple=True)
+
+        self._unacked_tag = None
+        self._unacked_count = 0
+
     def on_message(self, channel: pika.channel.Channel, method_frame: pika.frame.Method,
                    properties: pika.BasicProperties, body: bytes) -> None:
         """
+        The callback invoked by pika on the I/O loop's thread for each message. The message is handed over to the
+        worker thread, so that the I/O loop is never blocked by a task
+        """
+        if self.ack_mode == 'late':
+            self._outstanding[method_frame.delivery_tag] = False
+
+        self.messages.put((self.channel, method_frame, properties, body))
+
+    def defer_if_rate_limited(self, message: tuple) -> bool:
+        """
+        Takes a token for a message from the rate limits of its queue and task type. If the message has to wait for its
+        token, it is handed back to the worker once the token is available, and True is returned. Called on the worker
+        thread, so that shared rate limits do not block the I/O loop with database queries
+        """
+        channel, method_frame, properties, body = message
+        key = (channel, method_frame.delivery_tag)
+        if key in self._rate_limited:
+            self._rate_limited.remove(key)
+            return False
+
+        delay = self.get_rate_limit_delay(properties)
+        if delay <= 0:
+            return False
+
+        metrics.record('rate_limit.delay', delay, queue=self.queue)
+        self._rate_limited.add(key)
+        self.connection.add_callback_threadsafe(
+            functools.partial(self.connection.add_timeout, delay, functools.partial(self.messages.put, message)))
+        return True
+
+    def get_rate_limit_delay(self, properties: pika.BasicProperties) -> float:
+        """
+        Takes a token from the rate limits of the queue and of the message's task type (see :mod:`carrot.ratelimit`),
+        and returns the number of seconds to wait before the message may be consumed
+        """
+        delay = 0.0
+        if self.rate_limit:
+            delay = ratelimit.reserve('queue:%s' % self.queue, self.rate_limit)
+
+        task_type = (properties.headers or {}).get(self.serializer.type_header, None)
+        task_rate_limit = ratelimit.get_task_rate_limit(task_type)
+        if task_rate_limit:
+            delay = max(delay, ratelimit.reserve('task:%s' % task_type, task_rate_limit))
+
+        return delay
+
+    def process_message(self, channel: pika.channel.Channel, method_frame: pika.frame.Method,
+                        properties: pika.BasicProperties, body: bytes) -> None:
+        """
+        Consumes a message received on `channel`, on the worker thread. In **early** ack mode, the message is
+        acknowledged before it is consumed. In **late** ack mode, it is acknowledged once :meth:`consume` has returned,
+        and the result has been written to the MessageLog. Acknowledgements are handed back to the I/O loop's thread,
+        as pika is not thread safe
+        """
+        ack = functools.partial(self.ack, method_frame.delivery_tag, channel)
+
+        if self.ack_mode == 'early':
+            self.connection.add_callback_threadsafe(ack)
+
+        self.redelivered = method_frame.redelivered
+        self.running += 1
+        try:
+            with self.recycling((properties.headers or {}).get(self.serializer.type_header, 'unknown')):
+                self.consume(properties, body)
+        finally:
+            self.running -= 1
+
+        if self.ack_mode == 'late':
+            logwriter.after_flush(functools.partial(self.connection.add_callback_threadsafe, ack))
+
+    def consume(self, properties: pika.BasicProperties, body: bytes) -> None:
+        """
         The process that takes a single message from RabbitMQ, converts it into a python executable and runs it,
         logging the output back to the associated :class:`carrot.models.MessageLog`
 
         """
-        self.channel.basic_ack(method_frame.delivery_tag)
         log = self.__get_message_log(properties, body)
         if log:
             self.active_message_log = log
             log.status = 'IN_PROGRESS'
-            log.save()
         else:
             self.logger.error('Unable to find a MessageLog matching the uuid %s. Ignoring this task' %
                               properties.message_id)
@@ -312,7 +717,10 @@ class Consumer(threading.Thread):
             return self.fail(log, err)
 
         try:
-            args, kwargs = self.serializer.serialize_arguments(body.decode())
+            body = self.serializer.resolve_claim_check(properties, body)
+            body = self.serializer.decompress(body, properties.content_encoding)
+            args, kwargs = get_task_arguments(self.serializer, body, properties.content_type)
+            self.record_arguments(log, args, kwargs)
 
         except Exception as err:
             return self.fail(log, 'Unable to process the message due to an error collecting the task arguments: %s' % err)
@@ -322,10 +730,16 @@ class Consumer(threading.Thread):
                                                               func.__module__, func.__name__)
         self.logger.info(start_msg)
         self.task_log = [start_msg]
+
+        if getattr(func, 'carrot_batch', None):
+            # batch tasks are called with a batch of one message
+            args, kwargs = ([(args, kwargs)],), {}
+
         task = LoggingTask(func, self.logger, self.name, *args, **kwargs)
 
         try:
-            output = task.run()
+            with self.time_limits(func):
+                output = task.run()
 
             task_logs = task.get_logs()
             if task_logs:
@@ -356,9 +770,12 @@ class Consumer(threading.Thread):
                 save_attempts += 1
 
                 try:
-                    log.save()
+                    self.save_log(log, ['status', 'completion_time', 'output', 'log'])
                     self.active_message_log = None
 
+                    if log.claim_check:
+                        logwriter.after_flush(functools.partial(claimcheck.delete, log.claim_check))
+
                     break
                 except OperationalError:
                     if save_attempts > 10:
@@ -366,7 +783,7 @@ class Consumer(threading.Thread):
                                                'of carrot threads is too high. Either reduce the amount of '
                                                'scheduled tasks consumers, or increase the max number of '
                                                'connections supported by your database')
-                    self.connection.sleep(10)
+                    time.sleep(10)
 
         except Exception as err:
             task_logs = task.get_logs()
@@ -380,35 +797,163 @@ class Consumer(threading.Thread):
         """
         if self.channel:
             self.shutdown_requested = True
+            self.flush_acks()
             self.logger.warning('Shutdown received. Cancelling the channel')
             self.channel.basic_cancel(self.on_cancel, self._consumer_tag)
 
     def on_cancel(self, *args) -> None:
         """
-        Invoked when the channel cancel is completed.
+        Invoked when the channel cancel is completed. No more messages will be delivered, but the channel is left open
+        until the worker has finished its current task (see :meth:`on_worker_finished`), as closing it would requeue
+        the task's message in **late** ack mode, and drop any acknowledgements that are still pending. If the worker
+        is no longer running (or has been abandoned), the channel is closed straight away
 
         Parameters provided by Pika but not required by Carrot
         """
-        self.logger.info('Closing the channel')
-        self.channel.close()
+        self.messages.put(None)
+        worker = self.worker or self
+        if worker.is_alive() and not self.abandoned:
+            return
+
+        self.close_channel()
+
+    def close_channel(self) -> None:
+        """
+        Sends any pending acknowledgements, and then closes the channel. Must be called from the I/O loop's thread.
+
+        Messages that finished after an earlier message that was never run (e.g. as it was delayed by a rate limit) are
+        acknowledged individually, so that only the messages that did not run are redelivered
+        """
+        if self.channel and self.channel.is_open:
+            self.flush_acks()
+            for delivery_tag, finished in self._outstanding.items():
+                if finished:
+                    self.channel.basic_ack(delivery_tag)
+            self._outstanding = collections.OrderedDict()
+            self.logger.info('Closing the channel')
+            self.channel.close()
+
+    def on_worker_finished(self) -> None:
+        """
+        Called on the worker thread once it has stopped. If the consumer is shutting down, the channel is closed once
+        the results of its tasks have been written and their acknowledgements have been handed to the I/O loop
+        """
+        if self.shutdown_requested and self.connection and self.connection.is_open:
+            logwriter.after_flush(functools.partial(self.connection.add_callback_threadsafe, self.close_channel))
 
     def run(self) -> None:
         """
-        Process starts here
+        Process starts here. Starts the worker thread, and then runs the I/O loop until the connection is closed. Waits
+        for the worker thread to finish the current task before exiting
         """
-        self.connection = self.connect()
-        self.connection.ioloop.start()
+        if self.shared_connection:
+            return self.run_shared()
+
+        self.worker = threading.Thread(target=self.run_worker, name=self.name, daemon=True)
+        self.worker.start()
+
+        try:
+            self.connection = self.connect()
+            self.connection.ioloop.start()
+        finally:
+            self.messages.put(None)
+            # an abandoned worker may never finish, so it is not waited for
+            while self.worker.is_alive() and not self.abandoned:
+                self.worker.join(1)
+
+    def run_shared(self) -> None:
+        """
+        Registers the consumer with the shared connection, whose thread runs the I/O loop, and then consumes the
+        messages it receives on the consumer's own thread until the consumer is stopped
+        """
+        self.shared_connection.register(self)
+
+        try:
+            self.run_worker()
+        finally:
+            self.shared_connection.unregister(self)
+
+    def run_worker(self) -> None:
+        """
+        Runs :meth:`work`, and then closes the worker thread's database connections, so that retired consumers do not
+        hold on to them. If the consumer is stopping, the channel is then closed (see :meth:`on_worker_finished`)
+        """
+        try:
+            self.work()
+        finally:
+            self.on_worker_finished()
+            connections.close_all()
+
+    @property
+    def busy(self) -> bool:
+        """
+        Whether the consumer is running a task. Used by :meth:`.ConsumerSet.autoscale`
+        """
+        return self.running > 0
+
+    @contextlib.contextmanager
+    def recycling(self, task_type: str, count: int = 1) -> Iterator[None]:
+        """
+        Wraps the consumption of `count` messages for the given task type. Records the resident set size of the worker
+        afterwards, and how much it grew by, as the `worker.rss` and `worker.rss_growth` metrics, and then recycles the
+        consumer if it has reached its `max_tasks_per_worker` or `max_memory_per_worker`
+        """
+        rss = get_rss()
+        try:
+            yield
+        finally:
+            self.tasks_completed += count
+            current_rss = get_rss()
+            metrics.record('worker.rss', current_rss, queue=self.queue, worker=self.name)
+            metrics.record('worker.rss_growth', current_rss - rss, queue=self.queue, task=task_type)
+
+            if self.max_tasks_per_worker and self.tasks_completed >= self.max_tasks_per_worker:
+                self.recycle('it has consumed %i tasks' % self.tasks_completed)
+            elif self.max_memory_per_worker and self.active_task is not None and \
+                    current_rss > self.max_memory_per_worker * 1024 * 1024:
+                # thread consumers share the memory of the carrot process, so only consumer processes are recycled
+                # because of their memory use
+                self.recycle('its resident set size of %.1f MB exceeds its limit of %s MB'
+                             % (current_rss / 1024 / 1024, self.max_memory_per_worker))
+
+    def recycle(self, reason: str) -> None:
+        """
+        Stops the consumer once the current task has finished, so that it is replaced by a new one by
+        :meth:`.ConsumerSet.supervise`. Messages that the consumer has received but not yet taken are redelivered
+        """
+        if self.recycled or self.shutdown_requested:
+            return
+
+        self.logger.warning('Recycling consumer %s, as %s' % (self.name, reason))
+        self.recycled = True
+        metrics.record('worker.recycled', 1, queue=self.queue)
+        self.stop()
+
+    def work(self) -> None:
+        """
+        The worker loop. Consumes messages until the consumer is stopped. Any messages that have not been taken by the
+        worker when the consumer stops have not been acknowledged, so RabbitMQ will redeliver them
+        """
+        while True:
+            message = self.messages.get()
+            if message is None or self.shutdown_requested:
+                break
+
+            if not self.defer_if_rate_limited(message):
+                self.process_message(*message)
 
     def stop(self) -> None:
         """
-        Cleanly exit the Consumer
+        Cleanly exit the Consumer. The channel is cancelled on the I/O loop's thread, and the task currently running
+        (if any) is allowed to finish
         """
         self.logger.info('Stopping')
         self.shutdown_requested = True
+
         if self.channel:
-            self.stop_consuming()
-            self.connection.ioloop.start()
-            self.logger.info('Consumer closed')
+            self.connection.add_callback_threadsafe(self.stop_consuming)
+        elif self.shared_connection:
+            self.messages.put(None)
         else:
             self.logger.warning('Not running!')
 
@@ -418,32 +963,171 @@ class Consumer(threading.Thread):
         self.connection.close()
 
 
-class ListHandler(logging.Handler):
+class ConsumerConnection(threading.Thread):
     """
-    A :class:`logging.Handler` that records each log entry to a python list object, provided that the entry is coming
-    from the correct thread.
-
-    Allows for task-specific logging
+    A single connection to a virtual host that is shared by many consumers, with one channel for each. The connection's
+    I/O loop runs on this thread, and receives the messages for all consumers. Each consumer still consumes its messages
+    on its own thread.
 
+    The connection is reopened if it is lost, and closed once all of its consumers have stopped. Use
+    :func:`get_consumer_connection` to get the shared connection for a virtual host
     """
+    reconnect_timeout: int = 5
 
-    def __init__(self, thread_name: str, level: int):
-        self.output: List[str] = []
-        self.thread_name = thread_name
-        super(ListHandler, self).__init__(level)
+    def __init__(self, host: VirtualHost, logger: logging.Logger) -> None:
+        super().__init__(name='connection-%s' % host.host)
+        self.logger = logger
+        self._url = str(host)
+        self.connection: pika.SelectConnection = None
+        self.consumers: List[Consumer] = []
+        # the consumers whose channel has been requested on the current connection, so that each consumer only gets
+        # one channel, even if it registers while the connection is opening
+        self.channels_requested: List[Consumer] = []
+        # the number of consumers that have been given this connection by get_consumer_connection, but have not yet
+        # registered. The connection is kept open for them, even if all of its registered consumers have stopped
+        self.reserved = 0
+        self.shutdown_requested = False
+        self._lock = threading.Lock()
+
+    def connect(self) -> pika.SelectConnection:
+        self.logger.info('Connecting to %s', self._url)
+        return pika.SelectConnection(pika.URLParameters(self._url), self.on_connection_open, stop_ioloop_on_close=False)
+
+    def on_connection_open(self, connection: pika.SelectConnection) -> None:
+        self.logger.info('Shared connection opened')
+        self.connection.add_on_close_callback(self.on_connection_closed)
+
+        if self.shutdown_requested:
+            return self.close()
 
-    def emit(self, record: logging.LogRecord):
-        msg = self.format(record)
-        if msg.startswith(self.thread_name):
-            self.output.append(msg)
+        with self._lock:
+            consumers = list(self.consumers)
+            self.channels_requested = []
 
-    def parse_output(self) -> str:
-        return '\n'.join([str(line) for line in self.output])
+        for consumer in consumers:
+            self.open_channel(consumer)
+
+    def open_channel(self, consumer: Consumer) -> None:
+        """
+        Opens a channel for the given consumer, unless one has already been requested on the current connection. Must
+        be called from the connection's thread
+        """
+        if consumer.shutdown_requested or not self.connection.is_open:
+            return
+
+        with self._lock:
+            if consumer in self.channels_requested:
+                return
+            self.channels_requested.append(consumer)
+
+        consumer.connection = self.connection
+        self.connection.channel(on_open_callback=consumer.on_channel_open)
+
+    def channel_closed(self, consumer: Consumer) -> None:
+        """
+        Called when a consumer's channel has been closed, so that a new one can be opened for it
+        """
+        with self._lock:
+            if consumer in self.channels_requested:
+                self.channels_requested.remove(consumer)
+
+    def register(self, consumer: Consumer) -> None:
+        """
+        Adds a consumer to the connection. Its channel is opened as soon as the connection is open
+        """
+        with _consumer_connections_lock, self._lock:
+            self.reserved = max(0, self.reserved - 1)
+            if consumer not in self.consumers:
+                self.consumers.append(consumer)
+
+        if self.connection and self.connection.is_open:
+            self.connection.add_callback_threadsafe(functools.partial(self.open_channel, consumer))
+
+    def unregister(self, consumer: Consumer) -> None:
+        """
+        Removes a consumer from the connection, and closes the connection if no consumers remain, and none are waiting
+        to register
+        """
+        with _consumer_connections_lock, self._lock:
+            self.consumers.remove(consumer)
+            if consumer in self.channels_requested:
+                self.channels_requested.remove(consumer)
+            empty = not self.consumers and not self.reserved
+
+            if empty:
+                # from now on, get_consumer_connection starts a new connection rather than returning this one
+                self.shutdown_requested = True
+                if _consumer_connections.get(self._url) is self:
+                    del _consumer_connections[self._url]
+
+        if empty:
+            self.stop()
+
+    def on_connection_closed(self, *args) -> None:
+        if self.shutdown_requested:
+            self.logger.warning('Shared connection closed')
+            self.connection.ioloop.stop()
+        else:
+            self.logger.warning('Shared connection closed unexpectedly. Trying again in %i seconds'
+                                % self.reconnect_timeout)
+            self.connection.add_timeout(self.reconnect_timeout, self.reconnect)
+
+    def reconnect(self) -> None:
+        self.connection.ioloop.stop()
+
+        if not self.shutdown_requested:
+            self.connection = self.connect()
+            self.connection.ioloop.start()
+
+    def run(self) -> None:
+        self.connection = self.connect()
+        self.connection.ioloop.start()
+
+    def stop(self) -> None:
+        """
+        Closes the connection. Safe to call from any thread
+        """
+        self.shutdown_requested = True
+
+        with _consumer_connections_lock:
+            if _consumer_connections.get(self._url) is self:
+                del _consumer_connections[self._url]
+
+        if self.connection:
+            self.connection.add_callback_threadsafe(self.close)
+
+    def close(self) -> None:
+        if self.connection.is_open:
+            self.connection.close()
+        else:
+            self.connection.ioloop.stop()
+
+
+_consumer_connections: Dict[str, ConsumerConnection] = {}
+_consumer_connections_lock = threading.Lock()
+
+
+def get_consumer_connection(host: VirtualHost, logger: logging.Logger) -> ConsumerConnection:
+    """
+    Returns the running :class:`ConsumerConnection` for the given virtual host, starting a new one if required. The
+    connection is reserved for a consumer, which must then call :meth:`ConsumerConnection.register`, so that it is not
+    closed in the meantime by other consumers stopping
+    """
+    with _consumer_connections_lock:
+        connection = _consumer_connections.get(str(host))
+
+        if connection is None:
+            connection = _consumer_connections[str(host)] = ConsumerConnection(host, logger)
+            connection.start()
+
+        connection.reserved += 1
+        return connection
 
 
 class LoggingTask(object):
     """
-    Turns a function into a class with :meth:`.run()` method, and attaches a :class:`ListHandler` logging handler
+    Turns a function into a class with :meth:`.run()` method, and captures the log output of the function to a
+    :class:`carrot.tasklog.TaskLog`
     """
 
     def __init__(self, task: Callable, logger: logging.Logger, thread_name: str, *args, **kwargs):
@@ -453,35 +1137,520 @@ class LoggingTask(object):
 
         self.logger = logger
         self.thread_name = thread_name
-        self.stream_handler = ListHandler(thread_name, self.logger.getEffectiveLevel())
-        self.stream_handler.setLevel(self.logger.getEffectiveLevel())
-        formatter = logging.Formatter(LOGGING_FORMAT)
-        self.stream_handler.setFormatter(formatter)
-
-        self.logger.addHandler(self.stream_handler)
-
-        self._keep_alive = None
+        self.output = TaskLog()
+        tasklog.install(self.logger)
 
     def run(self) -> Callable:
-        output = self.task(*self.args, **self.kwargs)
-        return output
+        with tasklog.capture(self.output):
+            return self.task(*self.args, **self.kwargs)
 
     def get_logs(self) -> Optional[str]:
+        return str(self.output) if self.output else None
+
+
+class AsyncConsumer(Consumer):
+    """
+    A consumer that runs tasks concurrently on an asyncio event loop, on its worker thread. Coroutine functions
+    (`async def`) are awaited on the event loop, and up to `max_in_flight` tasks (set with the queue's `max_in_flight`
+    setting) are run at once. Regular functions are run in the event loop's default executor.
+
+    Database access (finding and updating the MessageLog) is also run in the executor, as Django's ORM is synchronous.
+    The consumer's prefetch count is raised to `max_in_flight` if it is lower, so that enough messages are received.
+
+    As tasks may finish in any order, in **late** ack mode, messages are only acknowledged once every message received
+    before them has finished too
+    """
+    max_in_flight: int = 100
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.max_in_flight = get_queue_settings(self.queue).get('max_in_flight', self.max_in_flight)
+        self.prefetch_count = max(self.prefetch_count, self.max_in_flight)
+        self.ack_batch_size = max(1, self.prefetch_count // 2)
+        self._claim_lock = threading.Lock()
+
+    def work(self) -> None:
+        asyncio.run(self.awork())
+
+    async def awork(self) -> None:
+        """
+        The worker loop. Takes messages and runs them as asyncio tasks, with up to `max_in_flight` running at once.
+        Waits for the running tasks to finish once the consumer is stopped
+        """
+        loop = asyncio.get_running_loop()
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+
+        while True:
+            await in_flight.acquire()
+            message = await loop.run_in_executor(None, self.messages.get)
+            if message is None or self.shutdown_requested:
+                break
+
+            if await run_sync(self.defer_if_rate_limited, message):
+                in_flight.release()
+                continue
+
+            task = loop.create_task(self.aprocess_message(*message))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda t: in_flight.release())
+
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def aprocess_message(self, channel: pika.channel.Channel, method_frame: pika.frame.Method,
+                               properties: pika.BasicProperties, body: bytes) -> None:
+        """
+        The asyncio equivalent of :meth:`Consumer.process_message`
+        """
+        ack = functools.partial(self.ack, method_frame.delivery_tag, channel)
+
+        if self.ack_mode == 'early':
+            self.connection.add_callback_threadsafe(ack)
+
+        self.running += 1
         try:
-            self.logger.removeHandler(self.stream_handler)
-            return self.stream_handler.parse_output()
-        except:
-            pass
-        return None
+            with self.recycling((properties.headers or {}).get(self.serializer.type_header, 'unknown')):
+                await self.aconsume(properties, body, method_frame.redelivered)
+        finally:
+            self.running -= 1
+
+        if self.ack_mode == 'late':
+            logwriter.after_flush(functools.partial(self.connection.add_callback_threadsafe, ack))
+
+    def claim_message_log(self, properties: pika.BasicProperties, body: bytes,
+                          redelivered: bool) -> Optional[MessageLog]:
+        """
+        Finds and claims the MessageLog for a message with :meth:`get_message_log`
+        """
+        with self._claim_lock:
+            self.redelivered = redelivered
+            log = self.get_message_log(properties, body)
+
+        if log:
+            log.status = 'IN_PROGRESS'
+
+        return log
+
+    async def aconsume(self, properties: pika.BasicProperties, body: bytes, redelivered: bool = False) -> None:
+        """
+        The asyncio equivalent of :meth:`Consumer.consume`. Each task keeps its own log, as many tasks run at once
+        """
+        log = None
+        for i in range(0, self.get_message_attempts):
+            log = await run_sync(self.claim_message_log, properties, body, redelivered)
+            if log:
+                break
+            await asyncio.sleep(0.1)
+
+        if not log:
+            self.logger.error('Unable to find a MessageLog matching the uuid %s. Ignoring this task' %
+                              properties.message_id)
+            return
+
+        task_log: List[str] = []
+
+        try:
+            task_type = self.get_task_type(properties.headers, body)
+            func = self.serializer.get_task(properties, body)
+            body = await run_sync(self.serializer.resolve_claim_check, properties, body)
+            body = self.serializer.decompress(body, properties.content_encoding)
+            args, kwargs = get_task_arguments(self.serializer, body, properties.content_type)
+            self.record_arguments(log, args, kwargs)
+        except Exception as err:
+            return await run_sync(self.fail, log, 'Unable to process the message: %s' % err, task_log,
+                                  traceback.format_exc())
+
+        self.logger.info('Consuming task %s, ID=%s' % (task_type, properties.message_id))
+        start_msg = '{} {} INFO:: Starting task {}.{}'.format(self.name,
+                                                              timezone.now().strftime("%Y-%m-%d %H:%M:%S,%f")[:-3],
+                                                              func.__module__, func.__name__)
+        self.logger.info(start_msg)
+        task_log.append(start_msg)
+        tasklog.install(self.logger)
+        output_log = TaskLog()
+
+        # coroutines are cancelled once their time limit has passed. Regular functions can't be interrupted
+        limit = (getattr(func, 'carrot_soft_time_limit', None) or self.soft_time_limit or
+                 getattr(func, 'carrot_time_limit', None) or self.time_limit)
+
+        try:
+            # the capture is local to this asyncio task, and is copied to the executor by run_sync
+            with tasklog.capture(output_log):
+                if asyncio.iscoroutinefunction(func):
+                    output = await asyncio.wait_for(func(*args, **kwargs), limit)
+                else:
+                    output = await run_sync(func, *args, **kwargs)
+        except asyncio.TimeoutError:
+            if output_log:
+                task_log.append(str(output_log))
+            return await run_sync(self.fail, log, 'The task exceeded its time limit of %s seconds' % limit, task_log,
+                                  traceback.format_exc())
+        except Exception as err:
+            if output_log:
+                task_log.append(str(output_log))
+            return await run_sync(self.fail, log, str(err), task_log, traceback.format_exc())
+
+        if output_log:
+            task_log.append(str(output_log))
+
+        success = '{} {} INFO:: Task {} completed successfully with response {}'.format(
+            self.name, timezone.now().strftime("%Y-%m-%d %H:%M:%S,%f")[:-3], log.task, output)
+        self.logger.info(success)
+        task_log.append(success)
+
+        log.status = 'COMPLETED'
+        log.completion_time = timezone.now()
+        log.output = json.dumps(output) if isinstance(output, dict) else output
+        log.log = '\n'.join(task_log)
+
+        await run_sync(self.save_log, log, ['status', 'completion_time', 'output', 'log'])
+
+        if log.claim_check:
+            await run_sync(logwriter.after_flush, functools.partial(claimcheck.delete, log.claim_check))
+
+
+class BatchConsumer(Consumer):
+    """
+    A consumer that runs tasks marked with :func:`carrot.utilities.batch_task` in batches. Consecutive messages for the
+    same batch task are collected until the task's `max_size` is reached, or `max_wait_ms` has passed since the first
+    one, and the task is then called once for the whole batch. The MessageLogs of a batch are read and updated in bulk.
+
+    Messages for other tasks are consumed one at a time, as by :class:`Consumer`.
+
+    In **late** ack mode, RabbitMQ will not deliver more than `prefetch_count` messages before they are acknowledged, so
+    batches are also sent once `prefetch_count` messages have been collected. The queue's `prefetch_count` should be at
+    least the `max_size` of its batch tasks
+    """
+
+    def work(self) -> None:
+        """
+        The worker loop. Collects messages for batch tasks, and runs each batch once it is full or has waited long enough
+        """
+        batch: List[tuple] = []
+        func: Optional[Callable] = None
+        deadline = 0.0
+
+        while True:
+            try:
+                message = self.messages.get(timeout=max(0.0, deadline - time.monotonic()) if batch else None)
+            except queue_module.Empty:
+                self.run_batch(func, batch)
+                batch = []
+                continue
+
+            if message is None or self.shutdown_requested:
+                break
+
+            if self.defer_if_rate_limited(message):
+                continue
+
+            channel, method_frame, properties, body = message
+            try:
+                task = self.serializer.get_task(properties, body)
+            except Exception:
+                task = None
+
+            if batch and task is not func:
+                self.run_batch(func, batch)
+                batch = []
+
+            options = getattr(task, 'carrot_batch', None)
+            if not options:
+                self.process_message(*message)
+                continue
+
+            if not batch:
+                func = task
+                deadline = time.monotonic() + options['max_wait_ms'] / 1000
+
+            if self.ack_mode == 'early':
+                self.connection.add_callback_threadsafe(functools.partial(self.ack, method_frame.delivery_tag, channel))
+
+            batch.append(message)
+            max_size = options['max_size'] if self.ack_mode == 'early' else min(options['max_size'],
+                                                                                self.prefetch_count)
+            if len(batch) >= max_size:
+                self.run_batch(func, batch)
+                batch = []
+
+        if batch:
+            self.run_batch(func, batch)
+
+    def claim_batch(self, batch: List[tuple]) -> Dict[str, MessageLog]:
+        """
+        Finds the MessageLogs for a batch of messages, and claims them with :meth:`carrot.models.MessageLog.claim`.
+        Returns a dict of MessageLogs by uuid
+        """
+        redelivered = {str(properties.message_id): method_frame.redelivered
+                       for channel, method_frame, properties, body in batch
+                       if self.serializer.log_header not in (properties.headers or {})}
+        logs: Dict[str, MessageLog] = {}
+
+        for channel, method_frame, properties, body in batch:
+            if self.serializer.log_header in (properties.headers or {}):
+                log = self.build_message_log(properties, body)
+                log.status = 'IN_PROGRESS'
+                logs[log.uuid] = log
+
+        for i in range(0, self.get_message_attempts):
+            missing = [uuid for uuid in redelivered if uuid not in logs]
+            claimed = MessageLog.claim([uuid for uuid in missing if not redelivered[uuid] or self.ack_mode == 'early'])
+
+            if self.ack_mode == 'late':
+                claimed += MessageLog.claim([uuid for uuid in missing if redelivered[uuid]],
+                                            ['PUBLISHED', 'IN_PROGRESS'])
+
+            logs.update((log.uuid, log) for log in claimed)
+
+            if all(uuid in logs for uuid in redelivered):
+                break
+            time.sleep(0.1)
+
+        return logs
+
+    def run_batch(self, func: Callable, batch: List[tuple]) -> None:
+        """
+        Runs :meth:`process_batch`, marking the consumer as busy while it runs
+        """
+        self.running += 1
+        try:
+            with self.recycling('%s.%s' % (func.__module__, func.__name__), len(batch)):
+                self.process_batch(func, batch)
+        finally:
+            self.running -= 1
+
+    def process_batch(self, func: Callable, batch: List[tuple]) -> None:
+        """
+        Runs a batch task for a batch of messages, saves the results to their MessageLogs in bulk, and then acknowledges
+        the messages, in **late** ack mode
+        """
+        logs = self.claim_batch(batch)
+        entries: List[MessageLog] = []
+        items: List[Tuple[tuple, dict]] = []
+        failed: List[Tuple[MessageLog, str, str]] = []
+
+        for channel, method_frame, properties, body in batch:
+            log = logs.get(str(properties.message_id))
+            if not log:
+                self.logger.error('Unable to find a MessageLog matching the uuid %s. Ignoring this task' %
+                                  properties.message_id)
+                continue
+
+            try:
+                body = self.serializer.resolve_claim_check(properties, body)
+                body = self.serializer.decompress(body, properties.content_encoding)
+                items.append(get_task_arguments(self.serializer, body, properties.content_type))
+                self.record_arguments(log, *items[-1])
+                entries.append(log)
+            except Exception as err:
+                failed.append((log, 'Unable to process the message due to an error collecting the task arguments: %s'
+                               % err, traceback.format_exc()))
+
+        self.task_log = []
+        results: List[Any] = []
+
+        if entries:
+            start_msg = '{} {} INFO:: Starting batch of {} tasks {}.{}'.format(
+                self.name, timezone.now().strftime("%Y-%m-%d %H:%M:%S,%f")[:-3], len(entries), func.__module__,
+                func.__name__)
+            self.logger.info(start_msg)
+            self.task_log = [start_msg]
+            task = LoggingTask(func, self.logger, self.name, items)
+
+            try:
+                output = task.run()
+                if isinstance(output, (list, tuple)) and len(output) == len(entries):
+                    results = list(output)
+                else:
+                    results = [output] * len(entries)
+            except Exception as err:
+                results = [err] * len(entries)
+
+            task_logs = task.get_logs()
+            if task_logs:
+                self.task_log.append(task_logs)
+
+        completed: List[MessageLog] = []
+        now = timezone.now()
+
+        for log, result in zip(entries, results):
+            if isinstance(result, Exception):
+                failed.append((log, str(result), ''.join(traceback.format_exception(type(result), result,
+                                                                                    result.__traceback__))))
+                continue
+
+            log.status = 'COMPLETED'
+            log.completion_time = now
+            log.output = json.dumps(result) if isinstance(result, dict) else result
+            log.log = '\n'.join(self.task_log)
+            completed.append(log)
+
+        for log, err, tb in failed:
+            self.logger.error('Task %s failed due to the following exception: %s' % (log.task, err))
+            task_log = list(self.task_log)
+
+            for cb in self.failure_callbacks:
+                try:
+                    cb(log, err)
+                    task_log.append('Failure callback %s succeeded' % str(cb))
+                except Exception as error:
+                    task_log.append('Failure callback %s failed due to an error: %s' % (str(cb), error))
+
+            log.status = 'FAILED'
+            log.failure_time = now
+            log.exception = err
+            log.traceback = tb
+            log.log = '\n'.join(task_log)
+
+        for log in completed:
+            tasklog.limit(log, ['output', 'log'])
+        for log, err, tb in failed:
+            tasklog.limit(log, ['log'])
+
+        # MessageLogs that were not created when the messages were published are only saved if they failed, and their
+        # log policy is failures_only
+
+        MessageLog.objects.bulk_update([log for log in completed if log.pk],
+                                       ['status', 'completion_time', 'output', 'log', 'truncated'])
+        MessageLog.objects.bulk_update([f[0] for f in failed if f[0].pk],
+                                       ['status', 'failure_time', 'exception', 'traceback', 'log', 'truncated'])
+        MessageLog.objects.bulk_create([f[0] for f in failed if not f[0].pk and f[0].log_policy == 'failures_only'])
+
+        for log, err, tb in failed:
+            if not log.pk and log.log_policy == 'none' and log.claim_check:
+                claimcheck.delete(log.claim_check)
+        self.logger.info('Batch of %i tasks completed: %i succeeded, %i failed'
+                         % (len(completed) + len(failed), len(completed), len(failed)))
+
+        for log in completed:
+            if log.claim_check:
+                claimcheck.delete(log.claim_check)
+
+        if self.ack_mode == 'late':
+            for channel, method_frame, properties, body in batch:
+                self.connection.add_callback_threadsafe(functools.partial(self.ack, method_frame.delivery_tag,
+                                                                          channel))
+
+
+def get_fork_context() -> multiprocessing.context.BaseContext:
+    """
+    Returns the multiprocessing context used by :class:`.ConsumerProcess`. Consumer processes are forked, so that the
+    consumer class and its arguments do not need to be pickled. Raises a `CarrotConfigException` on platforms that
+    cannot fork, such as Windows
+    """
+    try:
+        return multiprocessing.get_context('fork')
+    except ValueError:
+        raise CarrotConfigException('The process worker_type is not supported on this platform, as it cannot fork '
+                                    'new processes. Use the thread worker_type instead')
+
+
+class ConsumerProcess(multiprocessing.Process):
+    """
+    Runs a single :class:`.Consumer` in a child process, so that CPU bound tasks are not limited by the GIL. The
+    process exits cleanly once :meth:`stop` is called, or if its parent process dies.
+
+    The uuid of the task being consumed is shared with the parent in `active_task`, so that the parent can update the
+    task's MessageLog if the process dies unexpectedly
+    """
+    _start_method = 'fork'
+
+    @staticmethod
+    def _Popen(process_obj: multiprocessing.Process) -> Any:
+        # the fork context is only looked up when a process is started, so that this module can be imported on
+        # platforms that cannot fork
+        return get_fork_context().Process._Popen(process_obj)
+
+    def __init__(self, consumer_class: Type[Consumer], name: str, **consumer_kwargs) -> None:
+        context = get_fork_context()
+        super().__init__(name=name)
+        self.consumer_class = consumer_class
+        self.consumer_kwargs = consumer_kwargs
+        self.consumer_kwargs['name'] = name
+        self.shutdown_event = context.Event()
+        self.active_task = context.Array('c', 200)
+        self.task_deadline = context.Value('d', 0)
+        self.parent_pid = os.getpid()
+
+    def run(self) -> None:
+        # the parent process handles SIGINT, and then stops the child processes
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda *args: self.shutdown_event.set())
+
+        consumer = self.consumer_class(**self.consumer_kwargs)
+        consumer.active_task = self.active_task
+        consumer.task_deadline = self.task_deadline
+        consumer.start()
+
+        while not self.shutdown_event.wait(1):
+            if os.getppid() != self.parent_pid or not consumer.is_alive():
+                break
+
+        if not consumer.is_alive():
+            if getattr(consumer, 'recycled', False):
+                # exit cleanly, so that the process is replaced without failing a task
+                logwriter.close()
+                return
+
+            # the consumer thread has crashed. Exit with an error so that the process is replaced
+            os._exit(1)
+
+        consumer.stop()
+        consumer.join()
+        logwriter.close()
+
+    def stop(self) -> None:
+        self.shutdown_event.set()
+
+    @property
+    def busy(self) -> bool:
+        return bool(self.active_task.value)
+
+    @property
+    def deadline(self) -> float:
+        return self.task_deadline.value
+
+    def abandon(self, reason: str) -> None:
+        """
+        Kills the process, and marks the MessageLog of the task it was running as failed
+        """
+        uuid = self.active_task.value.decode()
+        self.kill()
+        self.join()
+        self.task_deadline.value = 0
+
+        if uuid:
+            MessageLog.objects.filter(uuid=uuid, status__in=['PUBLISHED', 'IN_PROGRESS']).update(
+                status='FAILED', failure_time=timezone.now(), exception=reason)
 
 
 class ConsumerSet(object):
     """
     Creates and starts 1 or more `.Consumer` objects. All consumers must belong to the same queue
+
+    By default, each consumer runs in its own thread. If the queue's `worker_type` setting is **process**, each
+    consumer runs in its own :class:`.ConsumerProcess` instead, and :meth:`supervise` replaces any processes that die
+
+    By default, each consumer opens its own connection to RabbitMQ. If the queue's `multiplex` setting is **True**,
+    the consumers open a channel on a :class:`.ConsumerConnection` shared by all multiplexed queues on the same
+    virtual host instead
+
+    If the queue has a `max_concurrency` setting, the number of consumers is adjusted to the queue's depth by
+    :meth:`autoscale`, between `min_concurrency` and `max_concurrency`
     """
     durable = True
     queue_arguments = {'x-max-priority': 255}
     exchange_arguments: Dict[str, Any] = {}
+    prefetch_count = 1
+    ack_mode = 'early'
+    worker_type = 'thread'
+    multiplex = False
+    min_concurrency = 1
+    max_concurrency: Optional[int] = None
+    autoscale_interval: float = 5
+    scale_down_delay: float = 60
 
     @staticmethod
     def get_consumer_class(consumer_class: str) -> Type[Consumer]:
@@ -498,14 +1667,17 @@ class ConsumerSet(object):
                  consumer_class: str = 'carrot.consumer.Consumer'):
         self.logger = logger
         self.host = host
-        self.connection = host.blocking_connection
-        self.channel = self.connection.channel()
         self.queue = queue
 
         self.concurrency = concurrency
         self.name = '%s-%s' % (self.queue, name)
         self.consumer_class = self.get_consumer_class(consumer_class)
-        self.threads: List[Consumer] = []
+        self.threads: List[Union[Consumer, ConsumerProcess]] = []
+        self.retired: List[Union[Consumer, ConsumerProcess]] = []
+        self.shutdown_requested = False
+        self.last_sample = 0.0
+        self.scale_down_since: Optional[float] = None
+        self.next_index = concurrency
 
         try:
             queue_settings = [q for q in settings.CARROT.get('queues', []) if q.get('name', None) == self.queue]
@@ -523,6 +1695,43 @@ class ConsumerSet(object):
             if q_settings.get('exchange_arguments', None):
                 self.exchange_arguments = q_settings['exchange_arguments']
 
+            if q_settings.get('prefetch_count', None):
+                self.prefetch_count = q_settings['prefetch_count']
+
+            if q_settings.get('ack_mode', None):
+                self.ack_mode = q_settings['ack_mode']
+
+            if q_settings.get('worker_type', None):
+                self.worker_type = q_settings['worker_type']
+
+            if q_settings.get('multiplex', None):
+                self.multiplex = q_settings['multiplex']
+
+            for key in ['min_concurrency', 'max_concurrency', 'autoscale_interval', 'scale_down_delay']:
+                if q_settings.get(key, None) is not None:
+                    setattr(self, key, q_settings[key])
+
+        if self.worker_type not in WORKER_TYPES:
+            raise CarrotConfigException('Invalid worker_type %s. Must be one of: %s'
+                                        % (self.worker_type, ', '.join(WORKER_TYPES)))
+
+        if self.worker_type == 'process':
+            get_fork_context()
+
+        rate_limited = get_queue_settings(self.queue).get('rate_limit') or ratelimit.get_rate_limit_settings()['tasks']
+        if rate_limited and self.prefetch_count < 2 and not issubclass(self.consumer_class, AsyncConsumer):
+            self.logger.warning('Rate limits are configured, but the prefetch_count of queue %s is 1, so a message '
+                                'that is delayed by a rate limit blocks all other messages on the queue. Increase the '
+                                'prefetch_count so that other tasks can run in the meantime' % self.queue)
+
+        if self.max_concurrency is not None:
+            if not 0 < self.min_concurrency <= self.max_concurrency:
+                raise CarrotConfigException('Invalid autoscaling settings for queue %s: min_concurrency must be at '
+                                            'least 1, and no more than max_concurrency' % self.queue)
+
+            self.concurrency = self.next_index = min(max(self.concurrency, self.min_concurrency),
+                                                     self.max_concurrency)
+
     def stop_consuming(self) -> None:
         """
         Stops all running threads. Loops through the threads twice - firstly, to set the signal to **False** on all
@@ -532,24 +1741,239 @@ class ConsumerSet(object):
         for the earlier threads to finish. The second loop allows for quicker consumer stoppage and stops all consumers
         from consuming new tasks from the moment the signal is received
         """
+        self.shutdown_requested = True
+
         for t in self.threads:
             t.stop()
 
-        for t in self.threads:
+        for t in self.threads + self.retired:
             print('Closing consumer %s' % t)
-            t.join()
+            # tasks that exceed their hard time limit are abandoned, rather than waited for
+            while t.is_alive():
+                t.join(1)
+                self.check_time_limits()
             print('Closed consumer %s' % t)
 
+        logwriter.flush()
+
+    def create_consumer(self, index: int) -> Union[Consumer, ConsumerProcess]:
+        """
+        Creates the consumer (or consumer process, depending on the `worker_type`) for the given concurrency level
+
+        The `prefetch_count`, `ack_mode` and `shared_connection` arguments are only passed to the consumer class when
+        they differ from their defaults, so that custom consumer classes written before they were added still work
+        """
+        kwargs = {
+            'host': self.host,
+            'queue': self.queue,
+            'logger': self.logger,
+            'durable': self.durable,
+            'queue_arguments': self.queue_arguments,
+            'exchange_arguments': self.exchange_arguments,
+        }
+        if self.prefetch_count != ConsumerSet.prefetch_count:
+            kwargs['prefetch_count'] = self.prefetch_count
+
+        if self.ack_mode != ConsumerSet.ack_mode:
+            kwargs['ack_mode'] = self.ack_mode
+
+        name = '%s-%i' % (self.name, index + 1)
+
+        if self.worker_type == 'process':
+            return ConsumerProcess(self.consumer_class, name, **kwargs)
+
+        if self.multiplex:
+            kwargs['shared_connection'] = get_consumer_connection(self.host, self.logger)
+
+        return self.consumer_class(name=name, **kwargs)
+
     def start_consuming(self) -> None:
         """
-        Creates a thread for each concurrency level, e.g. if concurrency is set to 5, 5 threads are created.
+        Creates a thread (or process) for each concurrency level, e.g. if concurrency is set to 5, 5 threads are
+        created.
 
         A :class:`.Consumer` is attached to each thread and is started
         """
+        if self.worker_type == 'process':
+            # database connections must not be shared with child processes. They are reopened on demand
+            connections.close_all()
+
         for i in range(0, self.concurrency):
-            consumer = self.consumer_class(host=self.host, queue=self.queue, logger=self.logger,
-                                           name='%s-%i' % (self.name, i + 1),
-                                           durable=self.durable, queue_arguments=self.queue_arguments,
-                                           exchange_arguments=self.exchange_arguments)
+            consumer = self.create_consumer(i)
             self.threads.append(consumer)
             consumer.start()
+
+    def check_time_limits(self) -> None:
+        """
+        Abandons any consumer whose task has exceeded its hard time limit (see :meth:`.Consumer.abandon` and
+        :meth:`.ConsumerProcess.abandon`), and replaces it with a new consumer, unless the consumer set is stopping
+        """
+        for i, consumer in enumerate(self.threads):
+            deadline = getattr(consumer, 'deadline', 0)
+            if not deadline or deadline > time.time():
+                continue
+
+            reason = 'The task exceeded its time limit, and was abandoned by consumer %s' % consumer.name
+            self.logger.error(reason)
+            consumer.abandon(reason)
+            metrics.record('time_limit.exceeded', 1, queue=self.queue)
+
+            if not self.shutdown_requested:
+                if self.worker_type == 'process':
+                    connections.close_all()
+                self.threads[i] = self.create_consumer(i)
+                self.threads[i].start()
+
+    def supervise(self) -> None:
+        """
+        Replaces any consumers whose task has exceeded its hard time limit, any consumers that have been recycled, and
+        any consumer processes that have died. If a process died while consuming a task, the task's MessageLog is marked
+        as failed, unless the queue uses late acknowledgement, in which case the message will be redelivered and the
+        task run again
+        """
+        if self.shutdown_requested:
+            return
+
+        self.check_time_limits()
+        self.retired = [t for t in self.retired if t.is_alive()]
+
+        if self.worker_type != 'process':
+            for i, consumer in enumerate(self.threads):
+                if getattr(consumer, 'recycled', False):
+                    self.logger.info('Replacing recycled consumer %s' % consumer.name)
+                    self.retired.append(consumer)
+                    self.threads[i] = self.create_consumer(i)
+                    self.threads[i].start()
+            return
+
+        for i, process in enumerate(self.threads):
+            if process.is_alive():
+                continue
+
+            if process.exitcode == 0:
+                self.logger.info('Replacing recycled consumer process %s' % process.name)
+                connections.close_all()
+                self.threads[i] = self.create_consumer(i)
+                self.threads[i].start()
+                continue
+
+            self.logger.error('Consumer process %s exited unexpectedly with code %s. Restarting it'
+                              % (process.name, process.exitcode))
+
+            uuid = process.active_task.value.decode()
+            if uuid and self.ack_mode == 'early':
+                MessageLog.objects.filter(uuid=uuid, status__in=['PUBLISHED', 'IN_PROGRESS']).update(
+                    status='FAILED', failure_time=timezone.now(),
+                    exception='The consumer process running this task exited unexpectedly with code %s'
+                              % process.exitcode)
+
+            connections.close_all()
+            self.threads[i] = self.create_consumer(i)
+            self.threads[i].start()
+
+    def add_consumers(self, count: int) -> None:
+        """
+        Creates and starts `count` new consumers
+        """
+        if self.worker_type == 'process':
+            connections.close_all()
+
+        for i in range(count):
+            consumer = self.create_consumer(self.next_index)
+            self.next_index += 1
+            self.threads.append(consumer)
+            consumer.start()
+
+    def retire_consumer(self, consumer: Union[Consumer, ConsumerProcess]) -> None:
+        """
+        Stops a consumer without waiting for it. The consumer finishes its current task (if any) before it exits
+        """
+        self.threads.remove(consumer)
+        self.retired.append(consumer)
+        consumer.stop()
+
+    def resize(self, concurrency: int) -> None:
+        """
+        Starts or retires consumers, so that `concurrency` consumers are running. Idle consumers are retired first. If
+        the queue is autoscaled, `concurrency` is kept between its `min_concurrency` and `max_concurrency`
+        """
+        if self.max_concurrency is not None:
+            concurrency = min(max(concurrency, self.min_concurrency), self.max_concurrency)
+
+        self.retired = [t for t in self.retired if t.is_alive()]
+        self.concurrency = concurrency
+
+        if len(self.threads) < concurrency:
+            self.add_consumers(concurrency - len(self.threads))
+
+        while len(self.threads) > concurrency:
+            idle = [t for t in self.threads if not getattr(t, 'busy', False)]
+            self.retire_consumer(idle[-1] if idle else self.threads[-1])
+
+    def get_queue_depth(self) -> int:
+        """
+        Returns the number of messages waiting in the queue, using a passive `queue_declare`
+        """
+        frame = get_pool(self.host).execute(
+            lambda connection, channel: channel.queue_declare(queue=self.queue, passive=True))
+        return frame.method.message_count
+
+    def autoscale(self) -> None:
+        """
+        Adjusts the number of consumers to the queue's depth, if the queue has a `max_concurrency` setting. Called
+        regularly by the carrot service; the queue is sampled at most once every `autoscale_interval` seconds
+
+        Each sample, the number of consumers needed is the number of busy consumers plus the number of messages waiting
+        in the queue, between `min_concurrency` and `max_concurrency`. If more are needed, they are started immediately.
+        If fewer are needed, and have been for `scale_down_delay` seconds, a single idle consumer is retired. Each
+        sample, and any change, is recorded with :mod:`carrot.metrics`
+        """
+        self.retired = [t for t in self.retired if t.is_alive()]
+
+        if self.max_concurrency is None or self.shutdown_requested:
+            return
+
+        now = time.monotonic()
+        if now - self.last_sample < self.autoscale_interval:
+            return
+        self.last_sample = now
+
+        try:
+            depth = self.get_queue_depth()
+        except Exception as err:
+            self.logger.warning('Unable to sample the depth of queue %s: %s' % (self.queue, err))
+            return
+
+        current = len(self.threads)
+        busy = len([t for t in self.threads if getattr(t, 'busy', False)])
+        target = min(max(busy + depth, self.min_concurrency), self.max_concurrency)
+
+        metrics.record('autoscale.queue_depth', depth, queue=self.queue)
+        metrics.record('autoscale.utilisation', busy / current if current else 0, queue=self.queue)
+
+        if target > current:
+            self.scale_down_since = None
+            self.logger.info('Queue %s has %i waiting messages and %i busy consumers. Adding %i consumers'
+                             % (self.queue, depth, busy, target - current))
+
+            self.add_consumers(target - current)
+            metrics.record('autoscale.scale_up', target - current, queue=self.queue)
+
+        elif target < current:
+            if self.scale_down_since is None:
+                self.scale_down_since = now
+
+            idle = [t for t in self.threads if not getattr(t, 'busy', False)]
+            if now - self.scale_down_since >= self.scale_down_delay and idle:
+                self.logger.info('Queue %s only needs %i consumers. Retiring %s' % (self.queue, target, idle[-1].name))
+                self.retire_consumer(idle[-1])
+                metrics.record('autoscale.scale_down', 1, queue=self.queue)
+
+                # each further consumer is only retired after another delay
+                self.scale_down_since = now
+
+        else:
+            self.scale_down_since = None
+
+        metrics.record('autoscale.concurrency', len(self.threads), queue=self.queue)
+        self.concurrency = len(self.threads)
@@ -1,2 +1,12 @@
 class CarrotConfigException(Exception):
     pass
+
+
+class SoftTimeLimitExceeded(Exception):
+    """
+    Raised inside a task that has run for longer than its soft time limit. Tasks may catch it to clean up before the
+    hard time limit is reached
+    """
+
+    def __init__(self, *args) -> None:
+        super().__init__(*args or ('The task exceeded its soft time limit',))
@@ -0,0 +1,218 @@
+"""
+This module implements write-behind updates of :class:`carrot.models.MessageLog` objects.
+
+By default, consumers save each MessageLog as soon as its status changes, which costs a database round trip for every
+status change of every task. When the `write_behind` setting is enabled, status changes are instead collected in a
+per-process buffer, and written by the :class:`LogWriter` thread with `bulk_update`, once `batch_size` changes are
+waiting or every `flush_interval` seconds.
+
+Changes to the same MessageLog are merged, so that only its latest state is written, and flushes are run one at a time,
+so the changes to each MessageLog are always written in order. Callbacks registered with :func:`after_flush` are run
+once every change made before them has been written: consumers use them to delay late acknowledgements (and the deletion
+of claim-check blobs) until the task's result has been saved.
+
+The buffer is flushed when the carrot service stops.
+
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, List, Callable, Iterable, Optional, Tuple, Set
+
+from django.conf import settings
+from django.db.utils import OperationalError
+
+from carrot.models import MessageLog
+
+logger = logging.getLogger('carrot')
+
+DEFAULT_WRITE_BEHIND_SETTINGS: Dict[str, Any] = {
+    'enabled': False,
+    'batch_size': 500,
+    'flush_interval': 1,
+}
+
+
+def get_write_behind_settings() -> Dict[str, Any]:
+    """
+    Returns the `write_behind` setting, with defaults applied
+    """
+    try:
+        conf = settings.CARROT.get('write_behind', {})
+    except AttributeError:
+        conf = {}
+
+    return dict(DEFAULT_WRITE_BEHIND_SETTINGS, **conf)
+
+
+def is_enabled() -> bool:
+    return bool(get_write_behind_settings()['enabled'])
+
+
+class LogWriter(threading.Thread):
+    """
+    Collects changes to MessageLog objects, and writes them in bulk
+    """
+    save_attempts: int = 10
+    retry_interval: float = 1
+
+    def __init__(self, batch_size: int = 500, flush_interval: float = 1) -> None:
+        super().__init__(name='carrot-log-writer', daemon=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pid = os.getpid()
+        self.stopped = False
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._pending: 'OrderedDict[Any, Tuple[MessageLog, Set[str]]]' = OrderedDict()
+        self._callbacks: List[Callable] = []
+
+    def update(self, log: MessageLog, fields: Iterable[str]) -> None:
+        """
+        Adds a change to the buffer. If the MessageLog already has a pending change, the two are merged
+        """
+        with self._condition:
+            fields = set(fields)
+            if log.pk in self._pending:
+                previous, previous_fields = self._pending[log.pk]
+                if previous is not log:
+                    for field in previous_fields - fields:
+                        setattr(log, field, getattr(previous, field))
+                fields |= previous_fields
+
+            self._pending[log.pk] = (log, fields)
+
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify()
+
+    def after_flush(self, callback: Callable) -> None:
+        """
+        Registers a callback to be run once every change added so far has been written
+        """
+        with self._condition:
+            self._callbacks.append(callback)
+
+    def run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self.stopped or len(self._pending) >= self.batch_size,
+                                         timeout=self.flush_interval)
+                stopped = self.stopped
+
+            self.flush()
+
+            if stopped:
+                break
+
+    def flush(self) -> None:
+        """
+        Writes all pending changes, grouped by the fields that have changed, and then runs the pending callbacks
+        """
+        with self._flush_lock:
+            with self._condition:
+                pending, self._pending = self._pending, OrderedDict()
+                callbacks, self._callbacks = self._callbacks, []
+
+            groups: Dict[frozenset, List[MessageLog]] = {}
+            for log, fields in pending.values():
+                groups.setdefault(frozenset(fields), []).append(log)
+
+            for fields, logs in groups.items():
+                self.write(logs, sorted(fields))
+
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as err:
+                    logger.error('Write-behind callback %s failed due to an error: %s' % (callback, err))
+
+    def write(self, logs: List[MessageLog], fields: List[str]) -> None:
+        for attempt in range(1, self.save_attempts + 1):
+            try:
+                MessageLog.objects.bulk_update(logs, fields, batch_size=self.batch_size)
+                return
+            except OperationalError as err:
+                if attempt == self.save_attempts:
+                    logger.error('Unable to save %i MessageLogs due to a database error: %s' % (len(logs), err))
+                    return
+                time.sleep(self.retry_interval)
+            except Exception as err:
+                logger.error('Unable to save %i MessageLogs due to an error: %s' % (len(logs), err))
+                return
+
+    def stop(self) -> None:
+        """
+        Stops the thread once all pending changes have been written
+        """
+        with self._condition:
+            self.stopped = True
+            self._condition.notify()
+
+        if self.is_alive():
+            self.join()
+        else:
+            self.flush()
+
+
+_writer: Optional[LogWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> LogWriter:
+    """
+    Returns the running :class:`LogWriter` of the current process, starting a new one if required
+    """
+    global _writer
+
+    with _writer_lock:
+        if _writer is None or _writer.stopped or _writer.pid != os.getpid():
+            conf = get_write_behind_settings()
+            _writer = LogWriter(conf['batch_size'], conf['flush_interval'])
+            _writer.start()
+
+        return _writer
+
+
+def save(log: MessageLog, fields: Iterable[str]) -> None:
+    """
+    Saves the given fields of a MessageLog. If write-behind is enabled, the change is added to the buffer, otherwise the
+    MessageLog is saved immediately
+    """
+    if is_enabled():
+        get_writer().update(log, fields)
+    else:
+        log.save()
+
+
+def after_flush(callback: Callable) -> None:
+    """
+    Runs a callback once all changes made so far have been written. If write-behind is disabled, the callback is run
+    immediately
+    """
+    if is_enabled():
+        get_writer().after_flush(callback)
+    else:
+        callback()
+
+
+def flush() -> None:
+    """
+    Writes all pending changes of the current process
+    """
+    if _writer is not None and _writer.pid == os.getpid():
+        _writer.flush()
+
+
+def close() -> None:
+    """
+    Writes all pending changes of the current process, and stops its writer thread
+    """
+    global _writer
+
+    with _writer_lock:
+        writer, _writer = _writer, None
+
+    if writer is not None and writer.pid == os.getpid():
+        writer.stop()
@@ -1,7 +1,10 @@
 import time
 
+from carrot.connections import close_pools
+from carrot import logwriter
 from carrot.consumer import ConsumerSet, LOGGING_FORMAT
 from carrot.models import ScheduledTask
+from carrot.outbox import OutboxRelay, is_enabled as outbox_enabled
 from carrot.objects import VirtualHost
 from carrot.scheduler import ScheduledTaskManager
 from django.core.management.base import BaseCommand, CommandParser
@@ -9,11 +12,13 @@ from django.conf import settings
 from carrot import DEFAULT_BROKER
 import sys
 import os
+import copy
+import importlib
 import logging
 import signal
 import psutil
 import types
-from typing import Optional
+from typing import Optional, List, Dict, Any
 
 
 class Command(BaseCommand):
@@ -24,7 +29,9 @@ class Command(BaseCommand):
     run = True
     help = 'Starts the carrot service.'
     scheduler: Optional[ScheduledTaskManager] = None
+    outbox_relay: Optional[OutboxRelay] = None
     active_consumer_sets: list = []
+    reload_requested = False
 
     def __init__(self,
                  stdout: str = None,
@@ -36,12 +43,119 @@ class Command(BaseCommand):
         """
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.request_reload)
+
+        self.active_consumer_sets = []
+        self.queue_config: Dict[str, Dict[str, Any]] = {}
         super(Command, self).__init__(stdout, stderr, nocolor)
 
     def exit_gracefully(self, signum: int, frame: types.FrameType) -> None:
         self.stdout.write(self.style.WARNING('Shutdown requested'))
         self.run = False
 
+    def request_reload(self, signum: int, frame: types.FrameType) -> None:
+        self.stdout.write(self.style.WARNING('Configuration reload requested'))
+        self.reload_requested = True
+
+    @staticmethod
+    def get_queues() -> List[Dict[str, Any]]:
+        """
+        Returns the settings of the queues that should be consumed
+        """
+        try:
+            return [q for q in settings.CARROT['queues'] if q.get('consumable', True)]
+        except (AttributeError, KeyError):
+            return [{
+                'name': 'default',
+                'host': DEFAULT_BROKER
+            }]
+
+    def reload_settings(self) -> None:
+        """
+        Re-imports the Django settings module, and replaces the `CARROT` setting with its new value. Other settings are
+        not reloaded
+        """
+        module = getattr(settings, 'SETTINGS_MODULE', None)
+        if not module:
+            return
+
+        try:
+            settings_module = importlib.reload(importlib.import_module(module))
+        except Exception as err:
+            self.stderr.write('Unable to reload the settings module %s. Keeping the current configuration: %s'
+                              % (module, err))
+            return
+
+        settings.CARROT = getattr(settings_module, 'CARROT', {})
+
+    def start_consumer_set(self, queue: Dict[str, Any], logger: logging.Logger) -> ConsumerSet:
+        """
+        Creates and starts a :class:`carrot.consumer.ConsumerSet` for the given queue settings
+        """
+        kwargs = {
+            'queue': queue['name'],
+            'logger': logger,
+            'concurrency': queue.get('concurrency', 1),
+        }
+
+        if queue.get('consumer_class', None):
+            kwargs['consumer_class'] = queue.get('consumer_class')
+
+        try:
+            vhost = VirtualHost(**queue['host'])
+        except TypeError:
+            vhost = VirtualHost(url=queue['host'])
+
+        c = ConsumerSet(host=vhost, **kwargs)
+        c.start_consuming()
+        self.active_consumer_sets.append(c)
+        self.queue_config[queue['name']] = copy.deepcopy(queue)
+        self.stdout.write(self.style.SUCCESS('Successfully started %i consumers for queue %s'
+                                             % (c.concurrency, queue['name'])))
+        return c
+
+    def stop_consumer_set(self, consumer_set: ConsumerSet) -> None:
+        consumer_set.stop_consuming()
+        self.active_consumer_sets.remove(consumer_set)
+        del self.queue_config[consumer_set.queue]
+        self.stdout.write(self.style.SUCCESS('Successfully stopped the consumers for queue %s' % consumer_set.queue))
+
+    def reconfigure(self, logger: logging.Logger) -> None:
+        """
+        Compares the queue settings with those of the running consumer sets, and only updates the consumer sets that
+        are affected:
+
+        - Consumer sets are started for new queues, and stopped for queues that have been removed, or are no longer
+          `consumable`
+        - If only the `concurrency` of a queue has changed, its consumer set is resized (see
+          :meth:`carrot.consumer.ConsumerSet.resize`)
+        - If any other setting of a queue has changed, its consumer set is restarted
+
+        The other consumer sets keep consuming throughout
+        """
+        queues = {queue['name']: queue for queue in self.get_queues()}
+
+        for consumer_set in list(self.active_consumer_sets):
+            old, new = self.queue_config[consumer_set.queue], queues.get(consumer_set.queue)
+
+            if new is None:
+                self.stop_consumer_set(consumer_set)
+
+            elif dict(old, concurrency=None) != dict(new, concurrency=None):
+                self.stop_consumer_set(consumer_set)
+                self.start_consumer_set(new, logger)
+
+            elif old.get('concurrency', 1) != new.get('concurrency', 1):
+                consumer_set.resize(new.get('concurrency', 1))
+                self.queue_config[consumer_set.queue] = copy.deepcopy(new)
+                self.stdout.write(self.style.SUCCESS('Resized queue %s to %i consumers'
+                                                     % (consumer_set.queue, consumer_set.concurrency)))
+
+        for name, queue in queues.items():
+            if name not in self.queue_config:
+                self.start_consumer_set(queue, logger)
+
     def terminate(self, *args) -> None:
         """
         Tells the scheduler (if running) and consumer sets to stop running, and waits for the response
@@ -50,6 +164,10 @@ class Command(BaseCommand):
             self.scheduler.stop()
             self.stdout.write(self.style.SUCCESS('Successfully closed scheduler'))
 
+        if self.outbox_relay:
+            self.outbox_relay.stop()
+            self.stdout.write(self.style.SUCCESS('Successfully closed outbox relay'))
+
         self.stdout.write('Terminating running consumer sets (%i)...' % len(self.active_consumer_sets))
         count = 0
         for consumer_set in self.active_consumer_sets:
@@ -57,6 +175,8 @@ class Command(BaseCommand):
             consumer_set.stop_consuming()
 
         self.stdout.write(self.style.SUCCESS('Successfully closed %i consumer sets' % count))
+        logwriter.close()
+        close_pools()
         sys.exit()
 
     def add_arguments(self, parser: CommandParser) -> None:
@@ -121,15 +241,6 @@ class Command(BaseCommand):
 
         run_scheduler = options['run_scheduler']
 
-        try:
-            queues = [q for q in settings.CARROT['queues'] if q.get('consumable', True)]
-
-        except (AttributeError, KeyError):
-            queues = [{
-                'name': 'default',
-                'host': DEFAULT_BROKER
-            }]
-
         if run_scheduler:
             self.scheduler = ScheduledTaskManager()
 
@@ -139,6 +250,12 @@ class Command(BaseCommand):
                 self.scheduler.start()
                 self.stdout.write(self.style.SUCCESS('Successfully started scheduler'))
 
+            # outbox
+            if outbox_enabled():
+                self.outbox_relay = OutboxRelay()
+                self.outbox_relay.start()
+                self.stdout.write(self.style.SUCCESS('Successfully started outbox relay'))
+
             # logger
             loglevel = getattr(logging, options.get('loglevel', 'DEBUG'))
 
@@ -159,26 +276,7 @@ class Command(BaseCommand):
             logger.addHandler(stream_handler)
 
             # consumers
-            for queue in queues:
-                kwargs = {
-                    'queue': queue['name'],
-                    'logger': logger,
-                    'concurrency': queue.get('concurrency', 1),
-                }
-
-                if queue.get('consumer_class', None):
-                    kwargs['consumer_class'] = queue.get('consumer_class')
-
-                try:
-                    vhost = VirtualHost(**queue['host'])
-                except TypeError:
-                    vhost = VirtualHost(url=queue['host'])
-
-                c = ConsumerSet(host=vhost, **kwargs)
-                c.start_consuming()
-                self.active_consumer_sets.append(c)
-                self.stdout.write(self.style.SUCCESS('Successfully started %i consumers for queue %s'
-                                                     % (c.concurrency, queue['name'])))
+            self.reconfigure(logger)
 
             self.stdout.write(self.style.SUCCESS('All queues consumer sets started successfully. Full logs are at %s.'
                                                  % options['logfile']))
@@ -191,6 +289,15 @@ class Command(BaseCommand):
                 if not self.run:
                     self.terminate()
 
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload_settings()
+                    self.reconfigure(logger)
+
+                for consumer_set in self.active_consumer_sets:
+                    consumer_set.supervise()
+                    consumer_set.autoscale()
+
                 if self.scheduler or options['testmode']:
                     new_qs = ScheduledTask.objects.filter(active=True)
                     active_pks = {st.pk for st in new_qs}
@@ -58,6 +58,14 @@ class Command(BaseCommand):
 
         self.delete_pid()
 
+    def reload(self) -> None:
+        """
+        Sends a SIGHUP to the process, which reloads the queue configuration without restarting it
+        """
+        assert self.pid, MissingPid('PIDFILE does not exist. The process may not be running')
+        os.kill(self.pid, signal.SIGHUP)
+        self.stdout.write(self.style.SUCCESS('Reload requested'))
+
     def add_arguments(self, parser: CommandParser) -> None:
         """
         This Command inherits the same arguments as :class:`carrot.management.commands.carrot.Command`, with the
@@ -147,8 +155,8 @@ class Command(BaseCommand):
 
         self.pid_file = options.pop('pidfile')
 
-        if mode not in ['start', 'stop', 'restart', 'status']:
-            raise argparse.ArgumentError('mode', 'Must be start, stop, restart or status')
+        if mode not in ['start', 'stop', 'restart', 'reload', 'status']:
+            raise argparse.ArgumentError('mode', 'Must be start, stop, restart, reload or status')
 
         if mode == 'start':
             self.stdout.write('Attempting to start the process')
@@ -170,6 +178,9 @@ class Command(BaseCommand):
             self.start(**options)
             self.stdout.write(self.style.SUCCESS('Process restarted successfully'))
 
+        elif mode == 'reload':
+            self.reload()
+
         elif mode == 'status':
             if self.pid:
                 self.stdout.write(self.style.SUCCESS('Service is running. PID: %i' % self.pid))
@@ -1,21 +1,104 @@
 import json
-import pprint
+import sys
+import time
 from django.core.management.base import BaseCommand, CommandError, CommandParser
-from carrot.utilities import publish_message
+from carrot.utilities import publish_message, publish_many, validate_task
+from typing import Iterator, Dict, Any, TextIO, Optional
 
 
 class Command(BaseCommand):
-    help = 'Queues a job for execution'
+    help = 'Queues a job for execution, or streams many jobs from a file of newline-delimited JSON objects'
+    count = 0
+    skipped = 0
 
     def add_arguments(self, parser: CommandParser) -> None:
-        parser.add_argument('job_name', type=str)
-        parser.add_argument('job_args', type=str, nargs='+')
+        parser.add_argument('job_name', type=str, nargs='?')
+        parser.add_argument('job_args', type=str, nargs='*')
+        parser.add_argument('-f', '--file', type=str, default=None,
+                            help='Publish the jobs listed in a file of newline-delimited JSON objects, or "-" to read '
+                                 'them from stdin. Each object may contain the keys task, args, kwargs, queue, '
+                                 'priority, exchange and routing_key. If a job_name is given, it is used for objects '
+                                 'that do not define a task')
+        parser.add_argument('--queue', type=str, default=None, help='The default queue for streamed jobs')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='The number of streamed jobs to publish per batch')
+        parser.add_argument('--progress-every', type=int, default=10000,
+                            help='Report progress every n streamed jobs')
+
+    def read_jobs(self, stream: TextIO, default_task: str = None, progress_every: int = 10000) -> Iterator[Dict[str, Any]]:
+        """
+        Yields the jobs from a stream of newline-delimited JSON objects, skipping blank or invalid lines and jobs whose
+        task can't be imported, and reports progress every `progress_every` jobs
+        """
+        start = time.monotonic()
+        self.count = 0
+        self.skipped = 0
+        # the error raised when importing each task, or None if it was imported successfully
+        task_errors: Dict[str, Optional[str]] = {}
+
+        for line_number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                job = json.loads(line)
+            except ValueError:
+                job = None
+
+            if isinstance(job, dict) and default_task:
+                job.setdefault('task', default_task)
+
+            if not isinstance(job, dict) or not job.get('task') or not isinstance(job['task'], str):
+                self.skipped += 1
+                self.stderr.write('Skipping invalid job on line %i: %s' % (line_number, line[:200]))
+                continue
+
+            task = job['task']
+            if task not in task_errors:
+                try:
+                    validate_task(task)
+                    task_errors[task] = None
+                except (ImportError, AttributeError, ValueError) as err:
+                    task_errors[task] = str(err)
+
+            if task_errors[task]:
+                self.skipped += 1
+                self.stderr.write('Skipping job with an invalid task on line %i: %s' % (line_number,
+                                                                                        task_errors[task]))
+                continue
+
+            yield job
+            self.count += 1
+
+            if progress_every and self.count % progress_every == 0:
+                elapsed = time.monotonic() - start
+                self.stdout.write('Queued %i jobs (%.0f jobs/s)' % (self.count, self.count / elapsed if elapsed else 0))
+
+    def stream(self, stream: TextIO, **options) -> None:
+        start = time.monotonic()
+        jobs = self.read_jobs(stream, options['job_name'], options['progress_every'])
+        count = publish_many(jobs, queue=options['queue'], chunk_size=options['chunk_size'])
+        elapsed = time.monotonic() - start
+
+        self.stdout.write(self.style.SUCCESS('Queued %i jobs in %.2fs (%.0f jobs/s). %i invalid jobs were skipped'
+                                             % (count, elapsed, count / elapsed if elapsed else 0, self.skipped)))
 
     def handle(self, *args, **options) -> None:
         job_name = options['job_name']
         job_args = options['job_args']
 
+        if options['file']:
+            if options['file'] == '-':
+                return self.stream(sys.stdin, **options)
+
+            with open(options['file'], 'r') as f:
+                return self.stream(f, **options)
+
+        if not job_name:
+            raise CommandError('Either a job_name or a --file must be provided')
+
         if job_args:
-            publish_message(job_name, *job_args)
+            publish_message(job_name, *job_args, queue=options['queue'])
         else:
-            publish_message(job_name)
+            publish_message(job_name, queue=options['queue'])
@@ -0,0 +1,101 @@
+"""
+This module provides a lightweight, in-process metrics registry.
+
+Carrot records metrics such as payload compression ratios with :func:`record`. Each metric is aggregated in memory (the
+count, total, minimum, maximum and last value are kept for each combination of name and tags), and can be inspected with
+:func:`snapshot`. To forward metrics to an external system (e.g. statsd), register a callback with :func:`add_callback`;
+it will be called with the name, value and tags of every recorded value.
+
+"""
+import logging
+import threading
+from typing import Dict, List, Tuple, Any, Callable
+
+logger = logging.getLogger('carrot')
+
+
+class Metric(object):
+    """
+    The aggregated values of a single metric
+    """
+
+    def __init__(self, name: str, tags: Dict[str, Any]) -> None:
+        self.name = name
+        self.tags = tags
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.last = value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'tags': self.tags,
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'last': self.last,
+        }
+
+
+class MetricsRegistry(object):
+    """
+    A thread-safe collection of :class:`Metric` objects
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._metrics: Dict[Tuple[str, Tuple], Metric] = {}
+        self.callbacks: List[Callable] = []
+
+    def record(self, name: str, value: float, **tags) -> None:
+        """
+        Records a single value for the metric with the given name and tags
+        """
+        key = (name, tuple(sorted(tags.items())))
+        with self._lock:
+            if key not in self._metrics:
+                self._metrics[key] = Metric(name, tags)
+            self._metrics[key].add(value)
+
+        for cb in self.callbacks:
+            try:
+                cb(name, value, tags)
+            except Exception as err:
+                logger.error('Metrics callback %s failed due to an error: %s' % (cb, err))
+
+    def snapshot(self, name: str = None) -> List[Dict[str, Any]]:
+        """
+        Returns the current values of all metrics, or all metrics with the given name
+        """
+        with self._lock:
+            return [m.as_dict() for m in self._metrics.values() if name is None or m.name == name]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._metrics = {}
+
+
+registry = MetricsRegistry()
+
+
+def record(name: str, value: float, **tags) -> None:
+    registry.record(name, value, **tags)
+
+
+def snapshot(name: str = None) -> List[Dict[str, Any]]:
+    return registry.snapshot(name)
+
+
+def add_callback(cb: Callable[[str, float, Dict[str, Any]], None]) -> None:
+    registry.callbacks.append(cb)
@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carrot', '0004_set_unique_task_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_id', models.CharField(max_length=200, unique=True)),
+                ('queue', models.CharField(max_length=200)),
+                ('exchange', models.CharField(blank=True, max_length=200, null=True)),
+                ('routing_key', models.CharField(blank=True, max_length=200, null=True)),
+                ('body', models.BinaryField()),
+                ('properties', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'ordering': ('pk',),
+            },
+        ),
+    ]
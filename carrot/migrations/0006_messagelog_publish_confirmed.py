@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carrot', '0005_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelog',
+            name='publish_confirmed',
+            field=models.BooleanField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('carrot', '0008_messagelog_unique_uuid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelog',
+            name='truncated',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -4,10 +4,10 @@ from carrot.objects import DefaultMessageSerializer
 class MessageSerializer(DefaultMessageSerializer):
     failing_method = 'serialize_arguments'
 
-    def serialize_arguments(self, body):
+    def serialize_arguments(self, body, content_type=None):
         if self.failing_method == 'serialize_arguments':
             raise AttributeError('test error message')
-        super(MessageSerializer, self).serialize_arguments(body)
+        super(MessageSerializer, self).serialize_arguments(body, content_type)
 
     def get_task(self, properties, body):
         if self.failing_method == 'get_task':
@@ -24,16 +24,28 @@ class IoLoop(object):
 
 
 class Channel(object):
+    is_open = True
+
     def __init__(self, *args, **kwargs):
         pass
 
+    @property
+    def _impl(self):
+        return self
+
     def basic_qos(*args, **kwargs):
         return
 
+    def confirm_delivery(self, callback=None, nowait=False):
+        return
+
+    def add_on_return_callback(self, callback):
+        return
+
     def queue_purge(self, queue=''):
         return
 
-    def add_on_close_callback(self):
+    def add_on_close_callback(self, callback=None):
         return
 
     @staticmethod
@@ -69,10 +81,15 @@ class Channel(object):
 
 
 class Connection(object):
+    is_open = True
+
     def __init__(self, *args, **kwargs):
         self.channel = Channel
         self.ioloop = IoLoop()
 
+    def process_data_events(self, time_limit=None):
+        return
+
     def connect(self):
         return self
 
@@ -89,20 +106,44 @@ class Connection(object):
     def add_timeout(self, reconnect_timeout, timeout):
         return
 
+    @staticmethod
+    def add_callback_threadsafe(callback):
+        callback()
+
+    def remove_timeout(self, timeout):
+        return
+
     def close(self):
         return
 
 
+class SharedConnection(Connection):
+    def __init__(self, *args, **kwargs):
+        super(SharedConnection, self).__init__(*args, **kwargs)
+        self.channel = self.open_channel
+
+    @staticmethod
+    def open_channel(on_open_callback=None):
+        on_open_callback(Channel())
+
+
 class Properties(object):
     message_id = 1234
+    content_type = 'application/json'
+    content_encoding = None
     delivery_tag = 1
+    redelivered = False
+    priority = 0
     headers = {'type': 'test'}
 
 
 class Consumer(object):
-    def join(self):
+    def join(self, timeout=None):
         return
 
+    def is_alive(self):
+        return False
+
     def stop(self):
         return
 
@@ -110,4 +151,21 @@ class Consumer(object):
         return
 
     def __init__(self, *args, **kwargs):
-        pass
\ No newline at end of file
+        pass
+
+
+class AsyncioConnection(object):
+    is_open = True
+
+    def __init__(self, parameters=None, on_open_callback=None, on_open_error_callback=None, on_close_callback=None,
+                 custom_ioloop=None):
+        self.loop = custom_ioloop
+        self.loop.call_soon(on_open_callback, self)
+
+    def channel(self, on_open_callback=None):
+        channel = Channel()
+        channel.add_on_close_callback = lambda callback: None
+        self.loop.call_soon(on_open_callback, channel)
+
+    def close(self):
+        return
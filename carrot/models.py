@@ -1,4 +1,6 @@
-from django.db import models
+from django.db import models, connections, router
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.core.validators import MinValueValidator
 
 # support for both django 1.x/2.x
@@ -13,7 +15,7 @@ import json
 import os
 import sys
 
-from typing import Optional, Iterable
+from typing import Optional, Iterable, List
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(BASE_DIR + '/carrot')
@@ -47,7 +49,7 @@ class MessageLog(models.Model):
     exchange = models.CharField(max_length=200, blank=True, null=True)  #: the exchange
     queue = models.CharField(max_length=200, blank=True, null=True)
     routing_key = models.CharField(max_length=200, blank=True, null=True)
-    uuid = models.CharField(max_length=200)
+    uuid = models.CharField(max_length=200, unique=True)
     priority = models.PositiveIntegerField(default=0)
 
     task = models.CharField(max_length=200)  #: the import path for the task to be executed
@@ -64,6 +66,19 @@ class MessageLog(models.Model):
 
     log = models.TextField(blank=True, null=True)
 
+    #: whether RabbitMQ has confirmed (True) or rejected (False) the message. Only used with publisher confirms
+    publish_confirmed = models.BooleanField(null=True, blank=True)
+
+    #: the blob store reference of the task arguments, if they were offloaded. See :mod:`carrot.claimcheck`
+    claim_check = models.CharField(max_length=200, null=True, blank=True)
+
+    #: the log policy of the message. Not saved: MessageLogs for messages published to queues with a log_policy other
+    #: than **full** are created by the consumer, and only saved if the policy requires it
+    log_policy = 'full'
+
+    #: whether the log or output were truncated. See :mod:`carrot.tasklog`
+    truncated = models.BooleanField(default=False)
+
     @property
     def virtual_host(self) -> Optional[str]:
         from carrot.utilities import get_host_from_name
@@ -88,6 +103,22 @@ class MessageLog(models.Model):
     def __str__(self) -> models.CharField:
         return self.task
 
+    @property
+    def full_log(self) -> Optional[str]:
+        """
+        The complete log of the task, including any part that was truncated
+        """
+        from carrot.tasklog import load
+        return load(self, 'log')
+
+    @property
+    def full_output(self) -> Optional[str]:
+        """
+        The complete output of the task, including any part that was truncated
+        """
+        from carrot.tasklog import load
+        return load(self, 'output')
+
     @property
     def positionals(self) -> Iterable:
         import ast
@@ -98,17 +129,63 @@ class MessageLog(models.Model):
 
     def requeue(self) -> 'MessageLog':
         """
-        Sends a failed MessageLog back to the queue. The original MessageLog is deleted
+        Sends a failed MessageLog back to the queue. The original MessageLog is deleted. If the task arguments were
+        offloaded to the blob store, they are read back from it
         """
         from carrot.utilities import publish_message
-        msg = publish_message(self.task, *self.positionals, priority=self.priority, queue=self.queue,
-                              exchange=self.exchange, routing_key=self.routing_key, **self.keywords)
+
+        if self.claim_check:
+            from carrot.claimcheck import load_arguments
+            positionals, keywords = load_arguments(self.claim_check)
+        else:
+            positionals, keywords = self.positionals, self.keywords
+
+        msg = publish_message(self.task, *positionals, priority=self.priority, queue=self.queue,
+                              exchange=self.exchange, routing_key=self.routing_key, **keywords)
 
         if self.pk:
             self.delete()
 
         return msg
 
+    @classmethod
+    def claim(cls, uuids: Iterable[str], statuses: Iterable[str] = ('PUBLISHED',)) -> List['MessageLog']:
+        """
+        Marks the MessageLogs with the given uuids as in progress, provided that their status is one of `statuses`, and
+        returns them. MessageLogs that are missing, or have already been claimed by another consumer, are not returned
+
+        Each MessageLog is claimed with a conditional `UPDATE`, so only one consumer can ever claim it, even if its
+        message is delivered more than once. On PostgreSQL, the claimed rows are read back with `RETURNING`, so the
+        whole batch is claimed in a single query
+        """
+        uuids = [str(uuid) for uuid in uuids]
+        statuses = list(statuses)
+        if not uuids:
+            return []
+
+        db = router.db_for_write(cls)
+        connection = connections[db]
+
+        if connection.vendor == 'postgresql':
+            fields = cls._meta.concrete_fields
+            qn = connection.ops.quote_name
+            sql = 'UPDATE {table} SET {status} = %s WHERE {uuid} IN ({uuids}) AND {status} IN ({statuses}) ' \
+                  'RETURNING {columns}'.format(table=qn(cls._meta.db_table), status=qn('status'), uuid=qn('uuid'),
+                                               uuids=', '.join(['%s'] * len(uuids)),
+                                               statuses=', '.join(['%s'] * len(statuses)),
+                                               columns=', '.join(qn(field.column) for field in fields))
+
+            with connection.cursor() as cursor:
+                cursor.execute(sql, ['IN_PROGRESS'] + uuids + statuses)
+                rows = cursor.fetchall()
+
+            return [cls.from_db(db, [field.attname for field in fields], row) for row in rows]
+
+        claimed = [uuid for uuid in uuids
+                   if cls.objects.filter(uuid=uuid, status__in=statuses).update(status='IN_PROGRESS')]
+
+        return list(cls.objects.filter(uuid__in=claimed)) if claimed else []
+
     class Meta:
         ordering = '-failure_time', '-completion_time', 'status', '-priority', '-publish_time',
 
@@ -177,3 +254,62 @@ class ScheduledTask(models.Model):
 
     def __str__(self) -> models.CharField:
         return self.task
+
+
+class OutboxMessage(models.Model):
+    """
+    A message that was published inside a database transaction while the outbox is enabled. It is stored alongside its
+    :class:`MessageLog` in the same transaction, and relayed to RabbitMQ by :mod:`carrot.outbox` once the transaction
+    has been committed
+    """
+    message_id = models.CharField(max_length=200, unique=True)  #: the uuid of the message and its MessageLog
+    queue = models.CharField(max_length=200)
+    exchange = models.CharField(max_length=200, blank=True, null=True)
+    routing_key = models.CharField(max_length=200, blank=True, null=True)
+    body = models.BinaryField()
+    properties = models.TextField()  #: the message properties, as JSON
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self) -> str:
+        return '%s (%s)' % (self.routing_key, self.created)
+
+    class Meta:
+        ordering = 'pk',
+
+
+class Blob(models.Model):
+    """
+    A message body offloaded by :class:`carrot.claimcheck.DatabaseStore`
+    """
+    key = models.CharField(max_length=200, unique=True)
+    data = models.BinaryField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return self.key
+
+
+class RateLimitBucket(models.Model):
+    """
+    The state of a token bucket that is shared by many consumer processes. See :mod:`carrot.ratelimit`
+    """
+    key = models.CharField(max_length=200, unique=True)
+    tokens = models.FloatField()
+    updated = models.FloatField()  #: the timestamp at which `tokens` was last updated
+
+    def __str__(self) -> str:
+        return self.key
+
+
+@receiver(post_delete, sender=MessageLog)
+def delete_claim_check(sender: type, instance: MessageLog, **kwargs) -> None:
+    """
+    Deletes the offloaded task arguments, and the spilled log and output, of a MessageLog when it is deleted
+    """
+    if instance.claim_check:
+        from carrot.claimcheck import delete
+        delete(instance.claim_check)
+
+    if instance.truncated:
+        from carrot.tasklog import delete
+        delete(instance)
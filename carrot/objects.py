@@ -1,12 +1,23 @@
+import functools
 import importlib
+import inspect
 import json
 import logging
+import random
+import time
 import uuid
-from typing import Tuple, Callable, Dict, Any, Union
+from contextlib import ExitStack
+from itertools import islice
+from typing import Tuple, Callable, Dict, Any, Union, Iterable, Optional
 
 import pika
 from django.utils import timezone
 
+from carrot import metrics, claimcheck
+from carrot.codecs import get_codec, get_compressor
+from carrot.exceptions import CarrotConfigException
+
+LOG_POLICIES = ('full', 'failures_only', 'sampled', 'none')
 
 
 class VirtualHost(object):
@@ -67,9 +78,9 @@ class VirtualHost(object):
         return 'amqp://%s:%s@%s:%s/%s' % (self.username, self.password, self.host, self.port, self.name)
 
     @property
-    def blocking_connection(self) -> pika.BlockingConnection:
+    def connection_parameters(self) -> pika.ConnectionParameters:
         """
-        Connect to the VHOST
+        Returns the parameters used to connect to the VHOST
         """
         credentials = pika.PlainCredentials(username=self.username, password=self.password)
         if self.name == '%2f':
@@ -77,10 +88,16 @@ class VirtualHost(object):
         else:
             vhost = self.name
 
-        params = pika.ConnectionParameters(host=self.host, port=self.port, virtual_host=vhost,
-                                           credentials=credentials, connection_attempts=10, ssl=self.secure,
-                                           heartbeat=1200)
-        return pika.BlockingConnection(parameters=params)
+        return pika.ConnectionParameters(host=self.host, port=self.port, virtual_host=vhost,
+                                         credentials=credentials, connection_attempts=10, ssl=self.secure,
+                                         heartbeat=1200)
+
+    @property
+    def blocking_connection(self) -> pika.BlockingConnection:
+        """
+        Connect to the VHOST
+        """
+        return pika.BlockingConnection(parameters=self.connection_parameters)
 
 
 class BaseMessageSerializer(object):
@@ -93,6 +110,8 @@ class BaseMessageSerializer(object):
     """
     content_type = 'application/json'
     type_header, message_type = ('',) * 2
+    claim_check_header = 'x-carrot-claim-check'
+    log_header = 'x-carrot-log'
     task_get_attempts = 20
 
     @classmethod
@@ -112,6 +131,7 @@ class BaseMessageSerializer(object):
 
     def __init__(self, message: 'Message') -> None:
         self.message = message
+        self._encoded_body: Optional[Tuple[Union[str, bytes], Optional[str]]] = None
 
     def publish_kwargs(self) -> dict:
         """
@@ -121,12 +141,13 @@ class BaseMessageSerializer(object):
         """
         exchange = self.message.exchange or ''
         routing_key = self.message.routing_key or 'default'
-        body = self.body()
+        body, content_encoding = self.encoded_body()
         return dict(exchange=exchange, routing_key=routing_key, body=body, mandatory=True)
 
-    def body(self) -> str:
+    def body(self) -> Union[str, bytes]:
         """
-        Returns the content to be added to the RabbitMQ message body
+        Returns the content to be added to the RabbitMQ message body, encoded with the codec registered for the
+        message's content type (see :mod:`carrot.codecs`)
 
         By default, this implementation returns a simple dict in the following format:
 
@@ -152,7 +173,53 @@ class BaseMessageSerializer(object):
         if kwargs:
             data['kwargs'] = kwargs
 
-        return json.dumps(data)
+        return get_codec(self.get_content_type()).dumps(data)
+
+    def encoded_body(self) -> Tuple[Union[str, bytes], Optional[str]]:
+        """
+        Returns a tuple containing the message body and its content encoding. If the message's queue has compression
+        enabled, and the body is larger than the queue's compression threshold, the body is compressed and the content
+        encoding is the compressor's name. Otherwise, the content encoding is None
+
+        The compression ratio and time are recorded as the `compression.ratio` and `compression.time` metrics
+
+        If the (compressed) body is larger than the queue's claim check threshold, it is written to the blob store
+        instead, and an empty body is returned. See :mod:`carrot.claimcheck`
+        """
+        if self._encoded_body is None:
+            body = self.body()
+            content_encoding = None
+            compression = getattr(self.message, 'compression', None)
+
+            if compression:
+                raw = body.encode() if isinstance(body, str) else body
+                if len(raw) > self.message.compression_threshold:
+                    start = time.perf_counter()
+                    compressed = get_compressor(compression).compress(raw)
+                    metrics.record('compression.time', time.perf_counter() - start, queue=self.message.queue,
+                                   encoding=compression)
+                    metrics.record('compression.ratio', len(compressed) / len(raw), queue=self.message.queue,
+                                   encoding=compression)
+
+                    if len(compressed) < len(raw):
+                        body, content_encoding = compressed, compression
+
+            threshold = getattr(self.message, 'claim_check_threshold', None)
+            if threshold is not None and len(body) > threshold:
+                self.message.claim_check = claimcheck.store_body(str(self.message.uuid), body,
+                                                                 self.get_content_type(), content_encoding)
+                body = b''
+
+            self._encoded_body = body, content_encoding
+
+        return self._encoded_body
+
+    def get_content_type(self) -> str:
+        """
+        Returns the content type of the message. This is the content type of the codec chosen for the message, if any,
+        or the serializer's default content type
+        """
+        return getattr(self.message, 'content_type', None) or self.content_type
 
     def properties(self) -> dict:
         """
@@ -161,35 +228,78 @@ class BaseMessageSerializer(object):
         In this implementation, the following is returned:
         - headers
         - content message_type
+        - content encoding
         - priority
         - message id
         - message message_type
 
         """
         headers = {self.type_header: self.message.task}
-        content_type = self.content_type
+        if getattr(self.message, 'claim_check', None):
+            headers[self.claim_check_header] = self.message.claim_check
+
+        if getattr(self.message, 'log_policy', 'full') != 'full':
+            # no MessageLog was created, so the consumer needs the details that it would otherwise have read from it
+            headers[self.log_header] = {
+                'policy': self.message.log_policy,
+                'exchange': self.message.exchange or '',
+                'routing_key': self.message.routing_key or self.message.queue,
+                'publish_time': timezone.now().isoformat(),
+            }
+
+        content_type = self.get_content_type()
         priority = self.message.priority
         message_id = str(self.message.uuid)
         message_type = self.message_type
+        content_encoding = self.encoded_body()[1]
 
         return dict(headers=headers, content_type=content_type, priority=priority, message_id=message_id,
-                    type=message_type)
+                    type=message_type, content_encoding=content_encoding)
 
     def publish(self, connection: pika.BlockingConnection, channel: pika.channel.Channel) -> None:
         """
-        Publishes a message to the channel
+        Publishes a message to the channel. The connection is not closed afterwards, as it is normally borrowed from a
+        :class:`carrot.connections.ConnectionPool`
         """
         kwargs = self.publish_kwargs()
         kwargs['properties'] = pika.BasicProperties(**self.properties())
         channel.basic_publish(**kwargs)
-        connection.close()
 
     @classmethod
-    def serialize_arguments(cls, body: str) -> Tuple[tuple, dict]:
+    def resolve_claim_check(cls, properties: pika.BasicProperties, body: bytes) -> Union[bytes, memoryview]:
         """
-        Extracts positional and keyword arguments to be sent to a function from the message body
+        If the message body was offloaded to the blob store, returns the body from the store. Otherwise, the body is
+        returned unchanged
         """
-        content = json.loads(body)
+        ref = (properties.headers or {}).get(cls.claim_check_header, None)
+        if ref:
+            return claimcheck.load_body(ref)[0]
+
+        return body
+
+    @classmethod
+    def decompress(cls, body: bytes, content_encoding: str = None) -> bytes:
+        """
+        Decompresses the message body, if the message's content encoding shows that it was compressed
+        """
+        if not content_encoding:
+            return body
+
+        start = time.perf_counter()
+        body = get_compressor(content_encoding).decompress(body)
+        metrics.record('decompression.time', time.perf_counter() - start, encoding=content_encoding)
+        return body
+
+    @classmethod
+    def serialize_arguments(cls, body: Union[str, bytes], content_type: str = None) -> Tuple[tuple, dict]:
+        """
+        Extracts positional and keyword arguments to be sent to a function from the message body. The body is decoded
+        with the codec registered for `content_type`, which should be taken from the message properties
+
+        Consumers call this with :func:`get_task_arguments`, so subclasses that override it with the earlier
+        `serialize_arguments(body)` signature are still supported
+        """
+        content = get_codec(content_type or cls.content_type).loads(body)
         args = content.get('args', ())
         kwargs = content.get('kwargs', {})
         return args, kwargs
@@ -200,6 +310,41 @@ class DefaultMessageSerializer(BaseMessageSerializer):
     message_type = 'django-carrot message'
 
 
+@functools.lru_cache(maxsize=None)
+def accepts_content_type(func: Callable, bound: bool = False) -> bool:
+    """
+    Returns True if a `serialize_arguments` implementation accepts the message's content type as well as its body. If
+    `bound` is True, the function's first argument is the class or instance it is bound to
+    """
+    try:
+        params = list(inspect.signature(func).parameters.values())
+    except (TypeError, ValueError):
+        return True
+
+    if any(p.kind == p.VAR_POSITIONAL for p in params):
+        return True
+
+    return len([p for p in params if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)]) - bound >= 2
+
+
+def get_task_arguments(serializer: Union[BaseMessageSerializer, type], body: Union[str, bytes, memoryview],
+                       content_type: str = None) -> Tuple[tuple, dict]:
+    """
+    Calls the serializer's :meth:`BaseMessageSerializer.serialize_arguments` with the message body and content type.
+
+    Serializers written for earlier versions of carrot implement `serialize_arguments(body)`, where the body is a
+    str. These are still supported: they are given the body decoded from UTF-8, and not the content type
+    """
+    method = serializer.serialize_arguments
+    if accepts_content_type(getattr(method, '__func__', method), hasattr(method, '__func__')):
+        return method(body, content_type)
+
+    if not isinstance(body, str):
+        body = str(body, 'utf-8')
+
+    return method(body)
+
+
 # noinspection PyUnresolvedReferences
 class Message(object):
     """
@@ -225,7 +370,8 @@ class Message(object):
                  exchange: str = '',
                  priority: int = 0,
                  task_args: tuple = (),
-                 task_kwargs: Union[str, dict] = None) -> None:
+                 task_kwargs: Union[str, dict] = None,
+                 content_type: str = None) -> None:
 
         if not task_kwargs or task_kwargs in ['{}', '"{}"']:
             task_kwargs = {}
@@ -239,6 +385,12 @@ class Message(object):
 
         assert isinstance(virtual_host, VirtualHost)
 
+        from carrot.utilities import get_queue_settings
+        queue_settings = get_queue_settings(queue)
+
+        if not content_type:
+            content_type = queue_settings.get('serializer', None)
+
         self.uuid = str(uuid.uuid4())
 
         self.virtual_host = virtual_host
@@ -250,6 +402,21 @@ class Message(object):
         self.task = task
         self.task_args = task_args
         self.task_kwargs = task_kwargs
+        self.content_type = get_codec(content_type).content_type if content_type else None
+        self.compression = queue_settings.get('compression', None)
+        self.compression_threshold = queue_settings.get('compression_threshold', 1024)
+        self.claim_check_threshold = queue_settings.get('claim_check_threshold', None)
+        self.claim_check: Optional[str] = None
+
+        self.log_policy = queue_settings.get('log_policy', 'full')
+        if self.log_policy not in LOG_POLICIES:
+            raise CarrotConfigException('Invalid log_policy %s for queue %s. Must be one of: %s'
+                                        % (self.log_policy, queue, ', '.join(LOG_POLICIES)))
+
+        if self.log_policy == 'sampled':
+            # sampled messages are logged in full, and the rest are only logged if they fail
+            sampled = random.random() < queue_settings.get('log_sample_rate', 0.1)
+            self.log_policy = 'full' if sampled else 'failures_only'
 
         self.formatter = DefaultMessageSerializer(self)
 
@@ -258,42 +425,140 @@ class Message(object):
         """
         Gets or creates the queue, and returns a tuple containing the object's VirtualHost's blocking connection,
         and its channel
+
+        .. note::
+            This creates a new, unpooled connection, which the caller is responsible for closing. :meth:`.publish` uses
+            a pooled connection from :func:`carrot.connections.get_pool` instead
         """
         connection = self.virtual_host.blocking_connection
         channel = connection.channel()
 
         return connection, channel
 
-    def publish(self, pika_log_level: int = logging.ERROR) -> Any:
+    def message_log(self) -> Any:
         """
-        Publishes the message to RabbitMQ queue and creates a MessageLog object so the progress of the task can be
-        tracked in the Django project's database
+        Returns an unsaved :class:`carrot.models.MessageLog` object for this message
         """
         from carrot.models import MessageLog
-        logging.getLogger("pika").setLevel(pika_log_level)
-        connection, channel = self.connection_channel
 
-        if isinstance(self.task_kwargs, str):
-            try:
-                json.dumps(self.task_kwargs)
-                keyword_arguments = self.task_kwargs
-            except json.decoder.JSONDecodeError:
-                keyword_arguments = '{}'
-        else:
-            keyword_arguments = json.dumps(self.task_kwargs)
+        # encoding the body first determines whether the arguments are offloaded to the blob store, in which case only
+        # the reference is saved to the MessageLog
+        self.formatter.encoded_body()
+        task_args: Optional[tuple] = None
+        keyword_arguments: Optional[str] = None
 
-        log = MessageLog.objects.create(
+        if not self.claim_check:
+            task_args = self.task_args
+            if isinstance(self.task_kwargs, str):
+                try:
+                    json.dumps(self.task_kwargs)
+                    keyword_arguments = self.task_kwargs
+                except json.decoder.JSONDecodeError:
+                    keyword_arguments = '{}'
+            else:
+                keyword_arguments = json.dumps(self.task_kwargs)
+
+        return MessageLog(
             status='PUBLISHED',
             queue=self.queue,
             exchange=self.exchange or '',
             routing_key=self.routing_key or self.queue,
             uuid=str(self.uuid),
             priority=self.priority,
-            task_args=self.task_args,
+            task_args=task_args,
             content=keyword_arguments,
+            claim_check=self.claim_check,
             task=self.task,
             publish_time=timezone.now(),
         )
 
-        self.formatter.publish(connection, channel)
+    def publish(self, pika_log_level: int = logging.ERROR) -> Any:
+        """
+        Publishes the message to RabbitMQ queue and creates a MessageLog object so the progress of the task can be
+        tracked in the Django project's database. If the queue's `log_policy` is not **full**, the MessageLog is
+        returned without being saved
+
+        If the outbox is enabled and this is called inside a database transaction, the message is recorded in the
+        outbox and only sent once the transaction is committed. See :mod:`carrot.outbox`
+        """
+        from carrot.connections import get_pool
+        from carrot import outbox
+        logging.getLogger("pika").setLevel(pika_log_level)
+
+        log = self.message_log()
+        if self.log_policy == 'full':
+            log.save()
+
+        if outbox.is_active():
+            outbox.record([self])
+        else:
+            get_pool(self.virtual_host).execute(self.formatter.publish)
+
         return log
+
+    async def apublish(self) -> Any:
+        """
+        The asyncio equivalent of :meth:`.publish`, for use in async views. The MessageLog is created in a worker thread,
+        and the message is published over the running event loop's shared connection. See :mod:`carrot.aio`
+        """
+        from carrot.aio import get_publisher, run_sync
+
+        def save_log() -> Any:
+            log = self.message_log()
+            if self.log_policy == 'full':
+                log.save()
+            return log
+
+        log = await run_sync(save_log)
+        await get_publisher(self.virtual_host).publish(self.formatter)
+        return log
+
+    @staticmethod
+    def publish_batch(messages: Iterable['Message'], chunk_size: int = 500, pika_log_level: int = logging.ERROR) -> int:
+        """
+        Publishes many messages at once. The messages are consumed from the iterable in chunks of `chunk_size`, so
+        generators are never held in memory in full. For each chunk, the MessageLog objects are created with a single
+        `bulk_create` query, and the messages are then published over one pooled channel per virtual host, which is
+        held for the duration of the batch. If the outbox is active, the messages are recorded in the outbox instead.
+
+        If publisher confirms are enabled, every message is published without waiting for its confirmation, and the
+        confirmations are then waited for once, at the end of the batch.
+
+        Returns the number of messages published
+        """
+        from carrot.models import MessageLog
+        from carrot.connections import get_pool, pool_key, ConfirmChannel
+        from carrot import outbox
+        logging.getLogger("pika").setLevel(pika_log_level)
+
+        use_outbox = outbox.is_active()
+        iterator = iter(messages)
+        channels: Dict[str, Tuple[pika.BlockingConnection, pika.channel.Channel]] = {}
+        count = 0
+
+        with ExitStack() as stack:
+            while True:
+                chunk = list(islice(iterator, chunk_size))
+                if not chunk:
+                    break
+
+                MessageLog.objects.bulk_create([msg.message_log() for msg in chunk if msg.log_policy == 'full'],
+                                               batch_size=chunk_size)
+                count += len(chunk)
+
+                if use_outbox:
+                    outbox.record(chunk)
+                    continue
+
+                for msg in chunk:
+                    key = pool_key(msg.virtual_host)
+                    if key not in channels:
+                        channels[key] = stack.enter_context(get_pool(msg.virtual_host).channel())
+
+                    msg.formatter.publish(*channels[key])
+
+            for connection, channel in channels.values():
+                if isinstance(channel, ConfirmChannel):
+                    channel.wait_for_confirms()
+
+        return count
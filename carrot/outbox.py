@@ -0,0 +1,200 @@
+"""
+This module implements the transactional outbox.
+
+When a message is published inside a database transaction, the consumer may receive it before the transaction (and
+therefore its :class:`carrot.models.MessageLog`) has been committed. When the outbox is enabled, messages published
+inside a transaction are instead stored as :class:`carrot.models.OutboxMessage` objects in the same transaction, and
+only sent to RabbitMQ once the transaction has been committed.
+
+Each transaction flushes its own messages in a single batch when it is committed. Any messages that could not be flushed
+(e.g. because the broker was unavailable, or because the publishing process exited first) are later picked up by the
+:class:`OutboxRelay`, which is run by the carrot service
+
+"""
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Iterable, List, Dict, Any
+
+import pika
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from carrot.connections import get_pool
+from carrot.models import OutboxMessage
+from carrot.objects import Message, VirtualHost
+
+logger = logging.getLogger('carrot')
+
+DEFAULT_OUTBOX_SETTINGS: Dict[str, Any] = {
+    'enabled': False,
+    'batch_size': 500,
+    'relay_interval': 5,
+    'relay_grace': 30,
+}
+
+_pending = threading.local()
+
+
+def get_outbox_settings() -> Dict[str, Any]:
+    """
+    Returns the `outbox` setting, with defaults applied
+    """
+    try:
+        conf = settings.CARROT.get('outbox', {})
+    except AttributeError:
+        conf = {}
+
+    return dict(DEFAULT_OUTBOX_SETTINGS, **conf)
+
+
+def is_enabled() -> bool:
+    return bool(get_outbox_settings()['enabled'])
+
+
+def is_active() -> bool:
+    """
+    Returns True if the outbox is enabled and the current thread is inside a database transaction, in which case
+    messages must be recorded in the outbox rather than published immediately
+    """
+    return is_enabled() and transaction.get_connection().in_atomic_block
+
+
+def outbox_message(message: Message) -> OutboxMessage:
+    """
+    Returns an unsaved :class:`carrot.models.OutboxMessage` containing everything needed to publish `message` later
+    """
+    kwargs = message.formatter.publish_kwargs()
+    body = kwargs['body']
+    if isinstance(body, str):
+        body = body.encode()
+
+    return OutboxMessage(message_id=str(message.uuid), queue=message.queue, exchange=kwargs['exchange'],
+                         routing_key=kwargs['routing_key'], body=body,
+                         properties=json.dumps(message.formatter.properties()))
+
+
+def record(messages: Iterable[Message]) -> None:
+    """
+    Stores the messages in the outbox, and arranges for them to be flushed once the current transaction is committed
+    """
+    rows = [outbox_message(msg) for msg in messages]
+    OutboxMessage.objects.bulk_create(rows)
+
+    if not hasattr(_pending, 'message_ids'):
+        _pending.message_ids = []
+
+    _pending.message_ids.extend(row.message_id for row in rows)
+    transaction.on_commit(_flush_pending)
+
+
+def _flush_pending() -> None:
+    """
+    Called when a transaction is committed. Flushes every message recorded by this thread since the last flush. The
+    relay will retry any messages that cannot be published now, so errors are logged rather than raised
+    """
+    message_ids = getattr(_pending, 'message_ids', [])
+    _pending.message_ids = []
+
+    if message_ids:
+        try:
+            flush(message_ids)
+        except Exception as err:
+            logger.error('Unable to flush %i outbox messages; they will be retried by the relay: %s' %
+                         (len(message_ids), err))
+
+
+def relay(rows: List[OutboxMessage]) -> None:
+    """
+    Publishes a batch of outbox messages to RabbitMQ, using one pooled channel per virtual host
+    """
+    from carrot.utilities import get_host_from_name
+
+    hosts: Dict[str, VirtualHost] = {}
+    batches: Dict[str, List[OutboxMessage]] = {}
+    for row in rows:
+        if row.queue not in hosts:
+            hosts[row.queue] = get_host_from_name(row.queue)
+        batches.setdefault(row.queue, []).append(row)
+
+    for queue, batch in batches.items():
+        with get_pool(hosts[queue]).channel() as (connection, channel):
+            for row in batch:
+                channel.basic_publish(exchange=row.exchange or '', routing_key=row.routing_key, body=bytes(row.body),
+                                      properties=pika.BasicProperties(**json.loads(row.properties)), mandatory=True)
+
+
+def flush(message_ids: List[str] = None, older_than: int = None) -> int:
+    """
+    Publishes outbox messages in batches, deleting each batch once it has been published. If `message_ids` is
+    provided, only those messages are flushed. If `older_than` is provided, only messages created more than that many
+    seconds ago are flushed.
+
+    Returns the number of messages published
+    """
+    batch_size = get_outbox_settings()['batch_size']
+    count = 0
+
+    if message_ids is not None:
+        for i in range(0, len(message_ids), batch_size):
+            batch = list(OutboxMessage.objects.filter(message_id__in=message_ids[i:i + batch_size]))
+            if batch:
+                relay(batch)
+                OutboxMessage.objects.filter(pk__in=[row.pk for row in batch]).delete()
+                count += len(batch)
+
+        return count
+
+    qs = OutboxMessage.objects.all()
+    if older_than is not None:
+        qs = qs.filter(created__lt=timezone.now() - timedelta(seconds=older_than))
+
+    while True:
+        batch = list(qs[:batch_size])
+        if not batch:
+            break
+
+        relay(batch)
+        OutboxMessage.objects.filter(pk__in=[row.pk for row in batch]).delete()
+        count += len(batch)
+
+    return count
+
+
+class OutboxRelay(threading.Thread):
+    """
+    A thread that periodically publishes any outbox messages that were not flushed when their transaction was
+    committed. Only messages older than `grace` seconds are relayed, so that the relay does not race with the flush
+    performed by the publishing thread
+    """
+
+    def __init__(self, interval: int = None, grace: int = None) -> None:
+        threading.Thread.__init__(self)
+        conf = get_outbox_settings()
+        self.interval = interval if interval is not None else conf['relay_interval']
+        self.grace = grace if grace is not None else conf['relay_grace']
+        self.active = True
+
+    def run(self) -> None:
+        while self.active:
+            try:
+                count = flush(older_than=self.grace)
+                if count:
+                    logger.info('Outbox relay published %i messages' % count)
+            except Exception as err:
+                logger.error('Outbox relay failed: %s' % err)
+
+            waited = 0
+            while self.active and waited < self.interval:
+                time.sleep(1)
+                waited += 1
+
+    def stop(self) -> None:
+        """
+        Safely stop the relay
+        """
+        self.active = False
+        self.join()
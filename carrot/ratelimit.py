@@ -0,0 +1,170 @@
+"""
+This module implements token bucket rate limiting of tasks.
+
+Rate limits are written as a number of tasks per second, minute or hour, e.g. `100/s`, `30/m` or `1000/h`. They can be
+set for a whole queue, with the queue's `rate_limit` setting, or for a single task type, in the `tasks` of the
+`rate_limits` setting:
+
+.. code-block:: python
+
+    CARROT = {
+        'rate_limits': {
+            'tasks': {
+                'myapp.tasks.call_api': '10/s',
+            },
+            'shared': False,
+        },
+        'queues': [{
+            'name': 'default',
+            'rate_limit': '100/s',
+        }],
+    }
+
+Each rate limit is enforced by a token bucket, which holds up to one second's worth of tokens (and at least one). Each
+message takes a token when the consumer's worker takes it. If none are left, the message is delayed until its token has
+been refilled, rather than being run straight away, and the worker moves on to the next message. Delayed messages are
+not acknowledged until they have run, so they count towards the queue's `prefetch_count`, which should be greater
+than 1.
+
+By default, buckets are kept in memory, and shared by the consumer threads of each process. If `shared` is **True**,
+each bucket is stored as a :class:`carrot.models.RateLimitBucket` in the Django project's database instead, so that the
+limit holds across all processes and hosts that consume the queue.
+
+"""
+import logging
+import threading
+import time
+from typing import Dict, Any, Optional, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.utils import DatabaseError
+
+from carrot.exceptions import CarrotConfigException
+
+logger = logging.getLogger('carrot')
+
+DEFAULT_RATE_LIMIT_SETTINGS: Dict[str, Any] = {
+    'tasks': {},
+    'shared': False,
+}
+
+PERIODS = {
+    's': 1,
+    'm': 60,
+    'h': 3600,
+}
+
+
+def get_rate_limit_settings() -> Dict[str, Any]:
+    """
+    Returns the `rate_limits` setting, with defaults applied
+    """
+    try:
+        conf = settings.CARROT.get('rate_limits', {})
+    except AttributeError:
+        conf = {}
+
+    return dict(DEFAULT_RATE_LIMIT_SETTINGS, **conf)
+
+
+def parse_rate(rate: str) -> float:
+    """
+    Converts a rate limit such as `100/s` into a number of tasks per second
+    """
+    try:
+        count, period = str(rate).split('/')
+        return float(count) / PERIODS[period.strip()]
+    except (ValueError, KeyError):
+        raise CarrotConfigException('Invalid rate limit %s. Rate limits must be written as a number of tasks per second, '
+                                    'minute or hour, e.g. 100/s, 30/m or 1000/h' % rate)
+
+
+def get_task_rate_limit(task: Optional[str]) -> Optional[float]:
+    """
+    Returns the rate limit of a task type, in tasks per second, or None if it is not rate limited
+    """
+    rate = get_rate_limit_settings()['tasks'].get(task, None)
+    return parse_rate(rate) if rate else None
+
+
+def take(tokens: float, updated: float, now: float, rate: float, capacity: float) -> Tuple[float, float]:
+    """
+    Refills a bucket that held `tokens` at the time `updated`, and takes a token from it. The bucket may be left with
+    fewer than 0 tokens, in which case the token has been reserved for the time when it will be refilled. Returns the
+    tokens left, and the number of seconds to wait for the token
+    """
+    tokens = min(capacity, tokens + max(0.0, now - updated) * rate) - 1
+    return tokens, -tokens / rate if tokens < 0 else 0.0
+
+
+class TokenBucket(object):
+    """
+    A token bucket held in memory. Thread safe
+    """
+
+    def __init__(self, key: str, rate: float) -> None:
+        self.key = key
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self, now: float = None) -> float:
+        """
+        Takes a token, and returns the number of seconds to wait before using it
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self.tokens, delay = take(self.tokens, self.updated, now, self.rate, self.capacity)
+            self.updated = max(self.updated, now)
+
+        return delay
+
+
+class DatabaseTokenBucket(TokenBucket):
+    """
+    A token bucket stored as a :class:`carrot.models.RateLimitBucket`, so that it can be shared by many processes. The
+    row is locked while a token is taken. If the database cannot be reached, messages are not delayed
+    """
+
+    def reserve(self, now: float = None) -> float:
+        from carrot.models import RateLimitBucket
+
+        now = time.time() if now is None else now
+        try:
+            with transaction.atomic():
+                bucket, created = RateLimitBucket.objects.select_for_update().get_or_create(
+                    key=self.key, defaults={'tokens': self.capacity, 'updated': now})
+                tokens, delay = take(bucket.tokens, bucket.updated, now, self.rate, self.capacity)
+                RateLimitBucket.objects.filter(pk=bucket.pk).update(tokens=tokens, updated=max(bucket.updated, now))
+        except DatabaseError as err:
+            logger.warning('Unable to apply the rate limit %s due to a database error: %s' % (self.key, err))
+            return 0.0
+
+        return delay
+
+
+_buckets: Dict[Tuple[str, float, bool], TokenBucket] = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(key: str, rate: float) -> TokenBucket:
+    """
+    Returns the token bucket for the given key and rate, creating it if needed
+    """
+    shared = bool(get_rate_limit_settings()['shared'])
+    with _buckets_lock:
+        bucket = _buckets.get((key, rate, shared))
+        if bucket is None:
+            bucket = _buckets[(key, rate, shared)] = (DatabaseTokenBucket if shared else TokenBucket)(key, rate)
+
+    return bucket
+
+
+def reserve(key: str, rate: float) -> float:
+    """
+    Takes a token from the bucket with the given key, and returns the number of seconds to wait before using it
+    """
+    return get_bucket(key, rate).reserve()
@@ -0,0 +1,210 @@
+"""
+This module captures the log output of individual tasks, so that it can be saved to their
+:class:`carrot.models.MessageLog`.
+
+A single :class:`CaptureHandler` is attached to each consumer's logger. The buffer of the task that is currently
+running is held in a context variable, so each record is appended to the buffer of the task that logged it, whichever
+thread or asyncio task it is running on, without being compared against the other running tasks. Records logged
+outside a task are ignored.
+
+Each buffer is a ring buffer that keeps the last `task_log_max_lines` lines (default: 1000) of the task's output, so
+tasks that log heavily cannot exhaust the consumer's memory.
+
+The size of the log and output saved to each MessageLog is also limited, by the `log_storage` setting, so that large
+values do not slow down the monitor. Longer values are truncated to their head and tail. If `spill` is enabled (the
+default when the `claim_check` setting configures a blob store), the full value is first written to the blob store (see
+:mod:`carrot.claimcheck`), and it is read back only when a single MessageLog is requested from the API. If the blob
+store cannot be written to, the value is only truncated.
+
+"""
+import collections
+import contextlib
+import contextvars
+import logging
+from typing import Optional, Iterator, List, Dict, Any
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+
+from carrot.claimcheck import get_store
+
+logger = logging.getLogger('carrot')
+
+LOGGING_FORMAT = '%(threadName)-10s %(asctime)-10s %(levelname)s:: %(message)s'
+DEFAULT_MAX_LINES = 1000
+
+DEFAULT_LOG_STORAGE_SETTINGS: Dict[str, Any] = {
+    'max_log_size': 65536,
+    'max_output_size': 65536,
+    'spill': False,
+}
+
+#: the MessageLog fields whose size is limited, and the setting that limits each of them
+LIMITED_FIELDS = {
+    'log': 'max_log_size',
+    'output': 'max_output_size',
+}
+
+
+def get_max_lines() -> int:
+    """
+    Returns the `task_log_max_lines` setting
+    """
+    try:
+        return settings.CARROT.get('task_log_max_lines', DEFAULT_MAX_LINES)
+    except AttributeError:
+        return DEFAULT_MAX_LINES
+
+
+class TaskLog(object):
+    """
+    A bounded buffer of log lines. Once `max_lines` lines have been added, each new line replaces the oldest one
+    """
+
+    def __init__(self, max_lines: int = None) -> None:
+        self.lines: collections.deque = collections.deque(maxlen=max_lines or get_max_lines())
+        self.dropped = 0
+
+    def append(self, line: str) -> None:
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    def __str__(self) -> str:
+        lines: List[str] = list(self.lines)
+        if self.dropped:
+            lines.insert(0, '... %i earlier lines were discarded' % self.dropped)
+        return '\n'.join(lines)
+
+
+_current: 'contextvars.ContextVar[Optional[TaskLog]]' = contextvars.ContextVar('carrot_task_log', default=None)
+
+
+class CaptureHandler(logging.Handler):
+    """
+    A :class:`logging.Handler` that appends each record to the :class:`TaskLog` of the task that is running in the
+    current context
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.setFormatter(logging.Formatter(LOGGING_FORMAT))
+
+    def emit(self, record: logging.LogRecord) -> None:
+        task_log = _current.get()
+        if task_log is not None:
+            task_log.append(self.format(record))
+
+
+def install(logger: logging.Logger) -> None:
+    """
+    Attaches a :class:`CaptureHandler` to the logger, unless it already has one
+    """
+    if not any(isinstance(handler, CaptureHandler) for handler in logger.handlers):
+        logger.addHandler(CaptureHandler())
+
+
+@contextlib.contextmanager
+def capture(task_log: TaskLog) -> Iterator[TaskLog]:
+    """
+    Records the log output of the current context to `task_log`, until the block exits
+    """
+    token = _current.set(task_log)
+    try:
+        yield task_log
+    finally:
+        _current.reset(token)
+
+
+def get_log_storage_settings() -> Dict[str, Any]:
+    """
+    Returns the `log_storage` setting, with defaults applied. Values are only spilled by default if a blob store is
+    configured with the `claim_check` setting
+    """
+    try:
+        conf = settings.CARROT.get('log_storage', {})
+        defaults = dict(DEFAULT_LOG_STORAGE_SETTINGS, spill='claim_check' in settings.CARROT)
+    except AttributeError:
+        conf, defaults = {}, DEFAULT_LOG_STORAGE_SETTINGS
+
+    return dict(defaults, **conf)
+
+
+def truncate(value: str, max_size: int) -> str:
+    """
+    Shortens a string to around `max_size` characters, keeping its head and its tail
+    """
+    if len(value) <= max_size:
+        return value
+
+    head = max_size // 2
+    tail = max_size - head
+    return '%s\n... %i characters truncated ...\n%s' % (value[:head], len(value) - max_size,
+                                                        value[-tail:] if tail else '')
+
+
+def spill_key(log: Any, field: str) -> str:
+    return '%s.%s' % (log.uuid, field)
+
+
+def limit(log: Any, fields: List[str]) -> List[str]:
+    """
+    Truncates the given fields of a :class:`carrot.models.MessageLog` if they are longer than the `log_storage` limits,
+    spilling the full values to the blob store. Returns the names of the fields that need to be saved as a result
+    """
+    conf = get_log_storage_settings()
+    truncated = False
+
+    for field, size_setting in LIMITED_FIELDS.items():
+        value = getattr(log, field)
+        max_size = conf[size_setting]
+        if field not in fields or value is None or max_size is None:
+            continue
+
+        value = str(value)
+        if len(value) <= max_size:
+            continue
+
+        if conf['spill']:
+            try:
+                get_store().put(spill_key(log, field), value.encode())
+            except Exception as err:
+                logger.error('Unable to spill the %s of MessageLog %s to the blob store, so it will only be truncated: '
+                             '%s' % (field, log.uuid, err))
+
+        setattr(log, field, truncate(value, max_size))
+        log.truncated = truncated = True
+
+    return ['truncated'] if truncated else []
+
+
+def load(log: Any, field: str) -> Optional[str]:
+    """
+    Returns the full value of a field of a :class:`carrot.models.MessageLog`, reading it from the blob store if it was
+    spilled there
+    """
+    value = getattr(log, field)
+    if not log.truncated or not get_log_storage_settings()['spill']:
+        return value
+
+    try:
+        return bytes(get_store().get(spill_key(log, field))).decode()
+    except (OSError, ObjectDoesNotExist):
+        return value
+
+
+def delete(log: Any) -> None:
+    """
+    Deletes the spilled values of a :class:`carrot.models.MessageLog`
+    """
+    if not get_log_storage_settings()['spill']:
+        return
+
+    try:
+        for field in LIMITED_FIELDS:
+            get_store().delete(spill_key(log, field))
+    except Exception as err:
+        logger.error('Unable to delete the spilled values of MessageLog %s: %s' % (log.uuid, err))
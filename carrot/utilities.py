@@ -10,11 +10,12 @@ import importlib
 from django.conf import settings
 from carrot.objects import VirtualHost, Message
 from carrot.models import ScheduledTask, MessageLog
+from carrot.connections import get_pool
 from django.utils.decorators import method_decorator
 from carrot import DEFAULT_BROKER
 from carrot.exceptions import CarrotConfigException
 from django.db.utils import IntegrityError
-from typing import Dict, List, Union, Callable, Type, Any
+from typing import Dict, List, Union, Callable, Type, Any, Iterable, Iterator
 
 
 def get_host_from_name(name: str) -> VirtualHost:
@@ -66,6 +67,23 @@ def get_host_from_name(name: str) -> VirtualHost:
         raise CarrotConfigException('Cannot find queue called %s in settings.CARROT queue list' % name)
 
 
+def get_queue_settings(name: str) -> Dict[str, Any]:
+    """
+    Returns the configuration of the queue with the given name from `settings.CARROT['queues']`, or an empty dict if the
+    queue is not configured
+    """
+    try:
+        queues = settings.CARROT.get('queues', [])
+    except AttributeError:
+        queues = []
+
+    for queue in queues:
+        if queue.get('name', None) == name:
+            return queue
+
+    return {}
+
+
 def validate_task(task: Union[str, Callable]) -> str:
     """
     Helper function for dealing with task inputs which may either be a callable, or a path to a callable as a string
@@ -144,6 +162,103 @@ def publish_message(task: Union[str, Callable],
     return msg.publish()
 
 
+async def apublish_message(task: Union[str, Callable],
+                           *task_args,
+                           priority: int = 0,
+                           queue: str = None,
+                           exchange: str = '',
+                           routing_key: str = None,
+                           **task_kwargs) -> MessageLog:
+    """
+    The asyncio equivalent of :func:`.publish_message`, for publishing tasks from async views without blocking the
+    event loop
+    """
+    if not queue:
+        queue = 'default'
+    msg = create_message(task, queue, priority, task_args, exchange, routing_key, task_kwargs)
+    return await msg.apublish()
+
+
+def publish_many(invocations: Iterable[Dict[str, Any]],
+                 queue: str = None,
+                 priority: int = 0,
+                 chunk_size: int = 500) -> int:
+    """
+    Publishes many tasks at once, using :meth:`carrot.objects.Message.publish_batch`. Each invocation is a dict in the
+    following format, where all keys other than `task` are optional:
+
+    .. code-block:: python
+
+        {
+            'task': 'myapp.tasks.my_task',
+            'args': ('tuple', 'of', 'positional', 'arguments'),
+            'kwargs': {'keyword1': 'value'},
+            'queue': 'my-queue',
+            'priority': 0,
+            'exchange': '',
+            'routing_key': 'my-queue',
+        }
+
+    The `queue` and `priority` parameters are used for invocations that do not define their own. Invocations can be
+    provided by a generator, as they are only read `chunk_size` at a time. Returns the number of tasks published
+    """
+    hosts: Dict[str, VirtualHost] = {}
+    tasks: Dict[Any, str] = {}
+
+    def messages() -> Iterator[Message]:
+        for invocation in invocations:
+            _queue = invocation.get('queue') or queue or 'default'
+            if _queue not in hosts:
+                hosts[_queue] = get_host_from_name(_queue)
+
+            task = invocation['task']
+            if task not in tasks:
+                tasks[task] = validate_task(task)
+
+            yield Message(virtual_host=hosts[_queue], queue=_queue, routing_key=invocation.get('routing_key'),
+                          exchange=invocation.get('exchange', ''), task=tasks[task],
+                          priority=invocation.get('priority', priority), task_args=tuple(invocation.get('args', ())),
+                          task_kwargs=invocation.get('kwargs') or {})
+
+    return Message.publish_batch(messages(), chunk_size=chunk_size)
+
+
+def batch_task(max_size: int = 500, max_wait_ms: int = 1000) -> Callable:
+    """
+    Marks a task function as batch-aware. When consumed by a :class:`carrot.consumer.BatchConsumer`, messages for the
+    task are collected until `max_size` messages have been received, or `max_wait_ms` milliseconds have passed since
+    the first one, and then the function is called once with a list of `(args, kwargs)` tuples, one per message.
+
+    The function may return a list containing one result per message, in which case any result that is an exception
+    instance marks that message as failed. Any other return value is used as the output of every message. If the
+    function raises an exception, every message in the batch fails
+
+    Tasks are still published one message at a time, with :func:`publish_message` or :func:`publish_many`. The default
+    :class:`carrot.consumer.Consumer` calls the function with a batch of one message
+    """
+    def decorator(func: Callable) -> Callable:
+        func.carrot_batch = {'max_size': max_size, 'max_wait_ms': max_wait_ms}
+        return func
+
+    return decorator
+
+
+def time_limit(hard: float = None, soft: float = None) -> Callable:
+    """
+    Sets the time limits of a task function, in seconds, overriding the `time_limit` and `soft_time_limit` of the queue.
+
+    Once the soft limit has passed, :class:`carrot.exceptions.SoftTimeLimitExceeded` is raised inside the task. Once
+    the hard limit has passed, the task is abandoned (or its consumer process is killed), its MessageLog is marked as
+    failed, and its consumer is replaced
+    """
+    def decorator(func: Callable) -> Callable:
+        func.carrot_time_limit = hard
+        func.carrot_soft_time_limit = soft
+        return func
+
+    return decorator
+
+
 def create_scheduled_task(task: Union[str, Callable],
                           interval: Dict[str, int],
                           task_name: str = None,
@@ -283,8 +398,7 @@ def purge_queue() -> None:
         else:
             filters = queue['host']
         host = VirtualHost(**filters)
-        channel = host.blocking_connection.channel()
-        channel.queue_purge(queue=queue['name'])
+        get_pool(host).execute(lambda connection, channel: channel.queue_purge(queue=queue['name']))
 
 
 def requeue_all() -> None: